@@ -0,0 +1,312 @@
+import asyncio
+import threading
+import collections
+import queue
+import socket
+import logging
+
+try:
+    from .packet import Packet, ControlPacket, DataPacket, NTPPacket
+    from .mock import PacketInbox, MockQueueMixin, ControlPktHandler, DataPktHandler, NTPPktHandler
+    from .ports import lease_port
+    from . import probes
+    from . import recorder
+    from . import connpool
+except (ImportError, ModuleNotFoundError):
+    from packet import Packet, ControlPacket, DataPacket, NTPPacket
+    from mock import PacketInbox, MockQueueMixin, ControlPktHandler, DataPktHandler, NTPPktHandler
+    from ports import lease_port
+    import probes
+    import recorder
+    import connpool
+
+log = logging.getLogger(__name__)
+
+
+class AsyncMockBase(MockQueueMixin):
+    """
+    Runs a mock server on a single asyncio event loop instead of one thread
+    per request. Mirrors the socketserver API used by the tests:
+    serve_forever() in a thread, shutdown() and server_close() from another.
+    """
+    allow_reuse_address = True
+    response_timeout = 2.0
+    read_timeout = 3.0
+    socket_type = socket.SOCK_STREAM
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
+        host, port = server_address
+        if port is None:
+            port = lease_port()
+
+        self.RequestHandlerClass = RequestHandlerClass
+        self.queue = PacketInbox()
+        self.resp_q = queue.Queue()
+        self.send_response = False
+        self.ip = "127.0.0.1"
+
+        self.socket = socket.socket(socket.AF_INET, self.socket_type)
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_address = (host, port)
+
+        self._loop = None
+        self._shutdown_request = None
+        self._shutdown_pending = False
+        self._stopped = threading.Event()
+
+        if bind_and_activate:
+            try:
+                self.server_bind()
+                self.server_activate()
+            except:
+                self.server_close()
+                raise
+
+    def server_bind(self):
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+        probes.track_port(self.server_address[1], udp=self.socket_type == socket.SOCK_DGRAM)
+
+    def server_activate(self):
+        pass
+
+    def server_close(self):
+        self.socket.close()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def serve_forever(self, poll_interval=None):
+        self._stopped.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._stopped.set()
+
+    def shutdown(self):
+        self._shutdown_pending = True
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._shutdown_request.set)
+        self._stopped.wait()
+
+    async def _serve(self):
+        self._shutdown_request = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if self._shutdown_pending:
+            self._shutdown_request.set()
+
+        # Connections waiting for a response, oldest first
+        self._waiters = collections.deque()
+        # Responses taken from resp_q after their waiter timed out
+        self._spare = collections.deque()
+        # One token per response wanted by a connection
+        self._wanted = threading.Semaphore(0)
+        pump_stop = threading.Event()
+        pump = threading.Thread(target=self._pump_responses, args=(self._loop, pump_stop), daemon=True)
+        pump.start()
+        try:
+            await self._run(self._shutdown_request)
+        finally:
+            pump_stop.set()
+            pump.join()
+            self._loop = None
+            self._shutdown_pending = False
+
+    async def _run(self, shutdown_request):
+        raise NotImplementedError()
+
+    def _pump_responses(self, loop, stop):
+        # resp_q is filled by test threads. This single thread takes one
+        # response per waiting connection and hands it to the loop.
+        while not stop.is_set():
+            if not self._wanted.acquire(timeout=0.1):
+                continue
+            while not stop.is_set():
+                try:
+                    response = self.resp_q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                loop.call_soon_threadsafe(self._deliver, response)
+                break
+
+    def _deliver(self, response):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(response)
+                return
+        self._spare.append(response)
+
+    async def _next_response(self):
+        if self._spare:
+            return self._spare.popleft()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._wanted.release()
+        try:
+            return await asyncio.wait_for(waiter, self.response_timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(
+                'Expected response packet in queue! This should not happen!')
+
+    async def _connect_and_send(self, p, host, port):
+        # The pool is shared with the threaded mocks, so its blocking
+        # sockets are used from the default executor
+        loop = asyncio.get_running_loop()
+        try:
+            log.debug(f"Sending to {host}:{port}")
+            await loop.run_in_executor(None, connpool.POOL.send, p, host, port, self.persistent_connections,
+                                       lambda sock: recorder.record_socket(recorder.SENT, sock, p))
+            log.debug('Sent successfully')
+        except Exception as e:
+            log.error(e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+
+class AsyncMockServer(AsyncMockBase):
+    """
+    asyncio counterpart of MockServer. The RequestHandlerClass only selects
+    which packets are accepted: ControlPktHandler, DataPktHandler or
+    GeneralPktHandler for both.
+    """
+    request_queue_size = 4096
+
+    def server_activate(self):
+        self.socket.listen(self.request_queue_size)
+
+    async def _run(self, shutdown_request):
+        server = await asyncio.start_server(
+            self._handle, sock=self.socket, backlog=self.request_queue_size)
+        async with server:
+            await shutdown_request.wait()
+
+    async def _read(self, reader, n):
+        try:
+            return await asyncio.wait_for(reader.readexactly(n), self.read_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            raise ValueError(f'Peer did not send the expected {n} bytes')
+
+    async def _read_packet(self, reader, sock, data=None):
+        # data is the first byte if it was already read
+        if data is None:
+            try:
+                data = await self._read(reader, 1)
+            except ValueError:
+                raise ValueError(
+                    "Peer did not send a single byte to determine packet type!")
+
+        packet_type = Packet.packet_type(data)
+        if issubclass(self.RequestHandlerClass, ControlPktHandler) and packet_type != ControlPacket:
+            raise ValueError(
+                'Expected control packet but control bit is not set!')
+        if issubclass(self.RequestHandlerClass, DataPktHandler) and packet_type != DataPacket:
+            raise ValueError(
+                'Expected data/client packet but control bit is set!')
+
+        if packet_type == ControlPacket:
+            data += await self._read(reader, 10)
+        else:
+            data += await self._read(reader, 6)
+            key_len, value_len = DataPacket.len_from_header(data)
+            data += await self._read(reader, key_len + value_len)
+
+        recorder.record_socket(recorder.RECEIVED, sock, data)
+        return packet_type.parse(data)
+
+    async def _next_byte(self, reader):
+        # Session mode: first byte of the next packet, b'' once the peer is done
+        try:
+            return await asyncio.wait_for(reader.read(1), self.read_timeout)
+        except (asyncio.TimeoutError, ConnectionResetError):
+            return b''
+
+    async def _handle(self, reader, writer):
+        try:
+            sock = writer.get_extra_info('socket')
+            data = None
+            while True:
+                packet = await self._read_packet(reader, sock, data)
+                self.queue.put(packet)
+
+                if self.send_response:
+                    response = await self._next_response()
+                    if isinstance(response, Packet):
+                        writer.writelines(response.serialize_parts())
+                        await writer.drain()
+                        recorder.record_socket(recorder.SENT, sock, response)
+                    else:
+                        p, host, port = response
+                        await self._connect_and_send(p, host, port)
+
+                if not self.session or not (data := await self._next_byte(reader)):
+                    break
+        except Exception:
+            self.handle_error(writer, writer.get_extra_info('peername'))
+        finally:
+            writer.close()
+
+
+class _NTPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        sock = self.transport.get_extra_info('socket')
+        recorder.record_socket(recorder.RECEIVED, sock, data, addr)
+        try:
+            packet = NTPPacket.parse(data)
+            self.server.queue.put(packet)
+        except Exception:
+            self.server.handle_error(data, addr)
+            return
+
+        if self.server.send_response:
+            task = asyncio.ensure_future(self._respond(addr))
+            # Keep a reference until done, the loop only holds weak ones
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _respond(self, addr):
+        try:
+            response = await self.server._next_response()
+            if isinstance(response, Packet):
+                buffer = response.serialize()
+                self.transport.sendto(buffer, addr)
+                recorder.record_socket(recorder.SENT, self.transport.get_extra_info('socket'), buffer, addr)
+            else:
+                p, host, port = response
+                await self.server._connect_and_send(p, host, port)
+        except Exception:
+            self.server.handle_error(None, addr)
+
+
+class AsyncMockServerUDP(AsyncMockBase):
+    """
+    asyncio counterpart of MockServerUDP, answering NTP requests from resp_q.
+    """
+    socket_type = socket.SOCK_DGRAM
+
+    def __init__(self, server_address, RequestHandlerClass=NTPPktHandler, bind_and_activate=True):
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+    async def _run(self, shutdown_request):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _NTPProtocol(self), sock=self.socket)
+        try:
+            await shutdown_request.wait()
+        finally:
+            transport.close()
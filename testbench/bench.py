@@ -0,0 +1,252 @@
+import argparse
+import datetime
+import ipaddress
+import json
+import logging
+import re
+import socket
+import threading
+import timeit
+
+try:
+    import custom_logging
+    from packet import DataPacket, ControlPacket, NTPPacket, NTPTimestamp, PacketReader
+    from mock import MockServer, MockServerUDP, DataPktHandler, NTPPktHandler
+    from async_mock import AsyncMockServer
+    from ntp_responder import NTPResponder
+except (ImportError, ModuleNotFoundError):
+    from . import custom_logging
+    from .packet import DataPacket, ControlPacket, NTPPacket, NTPTimestamp, PacketReader
+    from .mock import MockServer, MockServerUDP, DataPktHandler, NTPPktHandler
+    from .async_mock import AsyncMockServer
+    from .ntp_responder import NTPResponder
+
+log = logging.getLogger(__name__)
+
+# name -> setup generator, yields the operation to time and tears down after
+BENCHMARKS = {}
+
+PAYLOAD_SIZES = [0, 64, 4096, 65536, 1 << 20]
+
+
+def benchmark(name):
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+for size in PAYLOAD_SIZES:
+    @benchmark(f"DataPacket.serialize/{size}")
+    def data_serialize(size=size):
+        packet = DataPacket('SET', b'key', bytes(size))
+        yield packet.serialize
+
+    @benchmark(f"DataPacket.parse/{size}")
+    def data_parse(size=size):
+        buffer = bytes(DataPacket('SET', b'key', bytes(size)).serialize())
+        yield lambda: DataPacket.parse(buffer)
+
+    @benchmark(f"PacketReader.feed/{size}")
+    def reader_feed(size=size):
+        buffer = bytes(DataPacket('SET', b'key', bytes(size)).serialize())
+        reader = PacketReader()
+
+        def op():
+            reader.feed(buffer)
+            reader.next_packet()
+        yield op
+
+
+def _control_packet():
+    return ControlPacket('LOOKUP', 1234, 42, ipaddress.IPv4Address('127.0.0.1'), 1400)
+
+
+def _ntp_packet():
+    return NTPPacket.from_datetime(datetime.datetime.now(), datetime.timedelta(seconds=1))
+
+
+@benchmark("ControlPacket.serialize")
+def control_serialize():
+    yield _control_packet().serialize
+
+
+@benchmark("ControlPacket.parse")
+def control_parse():
+    buffer = bytes(_control_packet().serialize())
+    yield lambda: ControlPacket.parse(buffer)
+
+
+@benchmark("ControlPacket.parse_many/1000")
+def control_parse_many():
+    buffer = bytes(_control_packet().serialize()) * 1000
+    yield lambda: ControlPacket.parse_many(buffer)
+
+
+@benchmark("NTPPacket.serialize")
+def ntp_serialize():
+    yield _ntp_packet().serialize
+
+
+@benchmark("NTPPacket.parse")
+def ntp_parse():
+    buffer = bytes(_ntp_packet().serialize())
+    yield lambda: NTPPacket.parse(buffer)
+
+
+@benchmark("NTPTimestamp.from_timestamp")
+def ntp_from_timestamp():
+    yield lambda: NTPTimestamp.from_timestamp(1700000000.123456)
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def _accept_and_parse(server_class):
+    server = server_class(("127.0.0.1", 0), DataPktHandler)
+    thread = _serve(server)
+    buffer = bytes(DataPacket('SET', b'key', bytes(64)).serialize())
+
+    def op():
+        with socket.create_connection(server.server_address) as sock:
+            sock.sendall(buffer)
+        if server.await_packet(DataPacket, 3.0) is None:
+            raise RuntimeError("Mock server did not receive the packet")
+    yield op
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@benchmark("MockServer.accept_and_parse")
+def mock_server_accept():
+    yield from _accept_and_parse(MockServer)
+
+
+@benchmark("AsyncMockServer.accept_and_parse")
+def async_mock_server_accept():
+    yield from _accept_and_parse(AsyncMockServer)
+
+
+@benchmark("MockServerUDP.ntp_round_trip")
+def mock_server_udp_round_trip():
+    server = MockServerUDP(("127.0.0.1", 0), NTPPktHandler)
+    server.send_response = True
+    thread = _serve(server)
+
+    response = _ntp_packet()
+    request = bytes(_ntp_packet().serialize())
+    sock = socket.socket(type=socket.SOCK_DGRAM)
+    sock.settimeout(3.0)
+
+    def op():
+        server.resp_q.put(response)
+        sock.sendto(request, server.server_address)
+        sock.recv(48)
+        server.queue.get(timeout=3.0)
+    yield op
+
+    sock.close()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@benchmark("NTPResponder.round_trip")
+def ntp_responder_round_trip():
+    responder = NTPResponder(("127.0.0.1", 0)).start()
+    request = _ntp_packet()
+    request.mode = NTPPacket.MODE_CLIENT
+    request = bytes(request.serialize())
+    sock = socket.socket(type=socket.SOCK_DGRAM)
+    sock.settimeout(3.0)
+    sock.connect(responder.server_address)
+
+    def op():
+        sock.send(request)
+        sock.recv(48)
+    yield op
+
+    sock.close()
+    responder.shutdown()
+    responder.server_close()
+
+
+def measure(setup, min_time=0.2, repeat=5):
+    """
+    Returns the best seconds per operation out of repeat runs of at least min_time.
+    """
+    gen = setup()
+    op = next(gen)
+    try:
+        timer = timeit.Timer(op)
+        number, elapsed = timer.autorange()
+        number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+        return min(timer.repeat(repeat, number)) / number
+    finally:
+        for _ in gen:
+            pass
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the names of all benchmarks that got slower than baseline by more than threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]["seconds_per_op"]
+        new = result["seconds_per_op"]
+        if new > old * (1 + threshold):
+            log.error(f"Regression in {name}: {old * 1e6:.2f}us -> {new * 1e6:.2f}us per op "
+                      f"(+{(new / old - 1) * 100:.0f}%)")
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                    prog = 'testbench bench',
+                    description = 'Benchmarks packet codecs and mock servers')
+
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("-k", "--filter", action="store", default=None,
+                        help="Only run benchmarks whose name matches this regex")
+    parser.add_argument("--save", action="store", help="Write results as JSON baseline")
+    parser.add_argument("--compare", action="store", help="JSON baseline to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Allowed slowdown relative to the baseline (0.25 = 25%%)")
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        custom_logging.register(logging.DEBUG)
+    else:
+        custom_logging.register(logging.INFO)
+
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.filter is not None and not re.search(args.filter, name):
+            continue
+
+        seconds = measure(setup, args.min_time, args.repeat)
+        results[name] = {"seconds_per_op": seconds, "ops_per_sec": 1 / seconds}
+        print(f"{name:<40} {seconds * 1e6:>12.3f} us/op {1 / seconds:>14.0f} ops/s")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"results": results}, f, indent=2, sort_keys=True)
+        log.info(f"Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            exit(1)
+        log.info(f"No regressions against {args.compare}")
@@ -0,0 +1,200 @@
+import subprocess
+import hashlib
+import inspect
+import json
+import sys
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def default_cache_path():
+    """
+    testbench-cache in the .git directory of the enclosing checkout, where
+    it never shows up as untracked, otherwise $XDG_CACHE_HOME/testbench/results
+    (~/.cache if unset).
+    """
+    try:
+        proc = subprocess.run(['git', 'rev-parse', '--absolute-git-dir'],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        git_dir = proc.stdout.decode().strip() if proc.returncode == 0 else ''
+    except OSError:
+        git_dir = ''
+    if git_dir:
+        return os.path.join(git_dir, 'testbench-cache')
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(cache_home, 'testbench', 'results')
+    log.info(f"Not in a git checkout, caching test results in {path}")
+    return path
+
+
+class ResultCache:
+    """
+    Content addressed cache of passed tests in default_cache_path().
+    The key of a test hashes the source of the test function and its
+    module, the content of every file in build_dir and the testbench
+    sources, so a test is only replayed if none of them changed. Binaries
+    are not tracked individually: any change in build_dir invalidates all
+    entries.
+
+    Entries are evicted least recently used first (by mtime, refreshed on
+    every hit) once the cache grows beyond max_bytes.
+
+    Examples
+    ----------
+    > cache = ResultCache()
+    > key = cache.key(test, build_dir)
+    > result = cache.get(key)
+    > if result is None:
+    >     result = run_test(test, build_dir)
+    >     cache.put(key, result)
+    """
+
+    def __init__(self, path=None, max_bytes=16 << 20):
+        self.path = path if path is not None else default_cache_path()
+        self.max_bytes = max_bytes
+        # path -> content hash, for files with unchanged (size, mtime)
+        self.file_hashes = {}
+        self._tree_hashes = {}
+        self._testbench_hash = None
+        os.makedirs(self.path, exist_ok=True)
+        self._load_file_hashes()
+
+    def _load_file_hashes(self):
+        try:
+            with open(os.path.join(self.path, 'files.json')) as f:
+                self.file_hashes = json.load(f)
+        except (OSError, ValueError):
+            self.file_hashes = {}
+
+    def _save_file_hashes(self):
+        tmp = os.path.join(self.path, f'files.json.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.file_hashes, f)
+        os.replace(tmp, os.path.join(self.path, 'files.json'))
+
+    def file_hash(self, path):
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        known = self.file_hashes.get(path)
+        if known is not None and known[:2] == stamp:
+            return known[2]
+        digest = _hash_file(path)
+        self.file_hashes[path] = stamp + [digest]
+        return digest
+
+    def tree_hash(self, root, suffix=''):
+        """
+        Hash of the names and contents of all files below root ending with
+        suffix. Computed once per ResultCache, so use a new one per run.
+        """
+        root = os.path.realpath(root)
+        if (root, suffix) in self._tree_hashes:
+            return self._tree_hashes[root, suffix]
+
+        h = hashlib.sha256()
+        for path, dirs, names in os.walk(root):
+            dirs.sort()
+            for name in sorted(names):
+                full = os.path.join(path, name)
+                if not name.endswith(suffix) or not os.path.isfile(full):
+                    continue
+                h.update(os.path.relpath(full, root).encode() + b'\0')
+                h.update(self.file_hash(full).encode())
+        self._save_file_hashes()
+        self._tree_hashes[root, suffix] = h.hexdigest()
+        return self._tree_hashes[root, suffix]
+
+    def testbench_hash(self):
+        if self._testbench_hash is None:
+            self._testbench_hash = self.tree_hash(os.path.dirname(os.path.abspath(__file__)), '.py')
+        return self._testbench_hash
+
+    def key(self, test, build_dir):
+        """
+        Cache key of a TestFunc, or None if its source is not available.
+        """
+        try:
+            source = inspect.getsource(test.wrapper)
+            module_file = inspect.getsourcefile(test.wrapper)
+        except (OSError, TypeError):
+            return None
+
+        h = hashlib.sha256()
+        for part in (str(CACHE_VERSION), sys.version, test.module, test.func_name, source,
+                     self.file_hash(module_file), self.tree_hash(build_dir), self.testbench_hash()):
+            h.update(part.encode() + b'\0')
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, key):
+        """
+        Returns the cached result dict (see TestResult.as_dict) or None.
+        """
+        if key is None:
+            return None
+        path = self._entry(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Marks the entry as recently used
+        os.utime(path)
+        return result
+
+    def put(self, key, result):
+        """
+        Stores a passed TestResult, failures are never cached.
+        """
+        if key is None or not result.succeeded:
+            return
+        path = self._entry(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(result.as_dict(), f)
+        os.replace(tmp, path)
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits max_bytes.
+        """
+        entries = []
+        total = 0
+        for path, _, names in os.walk(self.path):
+            for name in names:
+                if not name.endswith('.json') or path == self.path:
+                    continue
+                full = os.path.join(path, name)
+                try:
+                    st = os.stat(full)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, full))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, full in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(full)
+            except FileNotFoundError:
+                pass
+            total -= size
+        log.debug(f"Result cache holds {total} bytes")
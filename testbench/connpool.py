@@ -0,0 +1,139 @@
+import threading
+import select
+import socket
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+def _alive(sock):
+    # An idle connection is readable only if the peer closed or reset it
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return True
+        return sock.recv(1, socket.MSG_PEEK) != b''
+    except (OSError, ValueError):
+        return False
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of outgoing TCP connections keyed by (host, port).
+    Idle connections are health checked before reuse and closed after
+    idle_timeout seconds. At most max_per_peer connections (idle or in use)
+    are open to a peer; further acquire() calls wait for a release.
+    """
+
+    def __init__(self, max_per_peer=8, idle_timeout=30.0, connect_timeout=3.0):
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.cond = threading.Condition()
+        # (host, port) -> [(socket, released at)], most recently used last
+        self.idle = {}
+        # (host, port) -> number of open connections, idle ones included
+        self.open = {}
+
+    def _close(self, peer, sock):
+        # Called with self.cond held
+        sock.close()
+        self.open[peer] -= 1
+        self.cond.notify_all()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.cond:
+            for peer, conns in self.idle.items():
+                while conns and now - conns[0][1] > self.idle_timeout:
+                    self._close(peer, conns.pop(0)[0])
+
+    def acquire(self, host, port, timeout=None):
+        peer = (host, port)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.evict_idle()
+        with self.cond:
+            while True:
+                conns = self.idle.get(peer)
+                while conns:
+                    sock, _ = conns.pop()
+                    if _alive(sock):
+                        return sock
+                    log.debug(f"Dropping dead pooled connection to {host}:{port}")
+                    self._close(peer, sock)
+
+                if self.open.get(peer, 0) < self.max_per_peer:
+                    self.open[peer] = self.open.get(peer, 0) + 1
+                    break
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f'No connection to {host}:{port} became free within {timeout}s')
+                self.cond.wait(remaining)
+
+        try:
+            return socket.create_connection(peer, timeout=self.connect_timeout)
+        except:
+            with self.cond:
+                self.open[peer] -= 1
+                self.cond.notify_all()
+            raise
+
+    def release(self, host, port, sock, reuse=True):
+        peer = (host, port)
+        with self.cond:
+            if reuse:
+                self.idle.setdefault(peer, []).append((sock, time.monotonic()))
+                self.cond.notify_all()
+            else:
+                self._close(peer, sock)
+
+    def send(self, packet, host, port, persistent=True, sent=None):
+        """
+        Sends packet to (host, port). With persistent=False a new connection
+        is opened and closed afterwards, for peers expecting one packet per
+        connection; these do not count against max_per_peer. A pooled
+        connection that broke since its health check is retried once with a
+        fresh one. sent(sock) is called after the packet was written, while
+        the connection is still open.
+        """
+        if not persistent:
+            with socket.create_connection((host, port), timeout=self.connect_timeout) as sock:
+                packet.write_to(sock)
+                if sent is not None:
+                    sent(sock)
+            return
+
+        for attempt in range(2):
+            sock = self.acquire(host, port, self.connect_timeout)
+            try:
+                packet.write_to(sock)
+            except OSError:
+                self.release(host, port, sock, reuse=False)
+                if attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                self.release(host, port, sock, reuse=False)
+                raise
+
+            try:
+                if sent is not None:
+                    sent(sock)
+            except BaseException:
+                self.release(host, port, sock, reuse=False)
+                raise
+            self.release(host, port, sock)
+            return
+
+    def close(self):
+        with self.cond:
+            for peer, conns in self.idle.items():
+                for sock, _ in conns:
+                    self._close(peer, sock)
+            self.idle.clear()
+
+
+# Shared by all mock servers
+POOL = ConnectionPool()
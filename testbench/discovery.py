@@ -0,0 +1,93 @@
+import hashlib
+import json
+import ast
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _is_test_decorator(node):
+    # @test, @testrunner.test or @tb.test, with or without a call
+    if isinstance(node, ast.Call):
+        node = node.func
+    if isinstance(node, ast.Name):
+        return node.id == 'test'
+    if isinstance(node, ast.Attribute):
+        return node.attr == 'test'
+    return False
+
+
+def scan(source, filename='<unknown>'):
+    """
+    Names of the module level functions decorated with @test, in declaration
+    order, found without executing the module.
+    """
+    tree = ast.parse(source, filename)
+    return [node.name for node in tree.body
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and
+            any(_is_test_decorator(d) for d in node.decorator_list)]
+
+
+def default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'testbench', 'discovery.json')
+
+
+class DiscoveryIndex:
+    """
+    Cache of the @test functions of test files, so the runner only imports
+    modules containing selected tests. Entries are reused while size and
+    mtime of a file are unchanged, or its content hash when only the mtime
+    changed.
+
+    Tests registered dynamically, e.g. by calling test() in a loop, are not
+    found by the scan.
+
+    Examples
+    ----------
+    > index = DiscoveryIndex()
+    > if "test_join" in index.tests("tests/chord.py"):
+    >     importlib.import_module("chord")
+    > index.save()
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else default_cache_path()
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def tests(self, test_path):
+        test_path = os.path.realpath(test_path)
+        st = os.stat(test_path)
+        entry = self.entries.get(test_path)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+            return entry['tests']
+
+        with open(test_path, 'rb') as f:
+            source = f.read()
+        digest = hashlib.sha256(source).hexdigest()
+        if entry is None or entry['hash'] != digest:
+            log.debug(f"Scanning {test_path} for tests")
+            entry = {'tests': scan(source, test_path), 'hash': digest}
+        entry.update(size=st.st_size, mtime=st.st_mtime_ns)
+        self.entries[test_path] = entry
+        self.dirty = True
+        return entry['tests']
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError as ex:
+            log.debug(f"Could not write discovery cache {self.path}: {ex}")
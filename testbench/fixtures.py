@@ -0,0 +1,44 @@
+from functools import wraps
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestFailed(object):
+    def __init__(self, failed):
+        self._failed = failed
+        self.lock = threading.RLock()
+
+    @property
+    def get_failed(self):
+        self.lock.acquire()
+        return self._failed
+        self.lock.release()
+
+
+    def set_failed(self, x):
+        self.lock.acquire()
+        self._failed = x
+        self.lock.release()
+
+
+# Shared by the runner and the helpers registering cleanups, which must not
+# import testrunner itself
+TEST_FAILED = TestFailed(True)
+CLEANUP = []
+
+
+def cleanup(func):
+    @wraps(func)
+    def wrapper(*args, **kwds):
+        global TEST_FAILED, CLEANUP
+        kwds["failure"] = TEST_FAILED
+        try:
+            iterator = func(*args, **kwds)
+        except TypeError as ex:
+            log.fatal(f"Cleanup function {func.__name__} signature needs a **kwarg argument.")
+            exit(1)
+        CLEANUP.append(iterator)
+        return next(iterator)
+    return wrapper
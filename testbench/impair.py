@@ -0,0 +1,377 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import random
+import socket
+import logging
+
+try:
+    from .packet import PacketReader
+    from .ports import lease_port
+    from . import probes
+except (ImportError, ModuleNotFoundError):
+    from packet import PacketReader
+    from ports import lease_port
+    import probes
+
+log = logging.getLogger(__name__)
+
+
+class Impairment:
+    """
+    Impairments applied to one direction of a proxied connection, at packet
+    granularity. Times are in seconds, probabilities in [0, 1].
+
+    delay/jitter: every packet is held back delay + uniform(0, jitter)
+    loss: packet is dropped
+    duplicate: packet is sent twice
+    reorder: packet is held back an extra reorder_delay, so later packets overtake it
+    rate: bandwidth cap in bytes per second, None for unlimited
+    split: TCP packet is written in two parts split_delay apart
+    """
+
+    def __init__(self, delay=0.0, jitter=0.0, loss=0.0, duplicate=0.0, reorder=0.0, reorder_delay=0.01,
+                 rate=None, split=0.0, split_delay=0.001, seed=None):
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.rate = rate
+        self.split = split
+        self.split_delay = split_delay
+        self.seed = seed
+
+    @property
+    def active(self):
+        return bool(self.delay or self.jitter or self.loss or self.duplicate or self.reorder or
+                    self.rate is not None or self.split)
+
+
+class LinkStats:
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.duplicated = 0
+
+    def __repr__(self):
+        return (f"<LinkStats {self.packets} packets, {self.bytes} bytes, "
+                f"{self.dropped} dropped, {self.duplicated} duplicated>")
+
+
+class _Link:
+    """
+    Schedules the packets of one direction by due time and sends them
+    through send(data, split) in that order.
+    """
+
+    def __init__(self, profile, rng, stats, send):
+        self.profile = profile
+        self.rng = rng
+        self.stats = stats
+        self.send = send
+        # (due time, sequence number, packet)
+        self.heap = []
+        self.seq = itertools.count()
+        self.next_free = 0.0
+        self.wakeup = asyncio.Event()
+        self.closed = False
+
+    def submit(self, data):
+        p = self.profile
+        rng = self.rng
+        if p.loss and rng.random() < p.loss:
+            self.stats.dropped += 1
+            return
+
+        copies = 1
+        if p.duplicate and rng.random() < p.duplicate:
+            copies = 2
+            self.stats.duplicated += 1
+
+        now = asyncio.get_running_loop().time()
+        for _ in range(copies):
+            due = now + p.delay
+            if p.jitter:
+                due += rng.uniform(0, p.jitter)
+            if p.reorder and rng.random() < p.reorder:
+                due += p.reorder_delay
+            if p.rate is not None:
+                due = max(due, self.next_free)
+                self.next_free = due + len(data) / p.rate
+            heapq.heappush(self.heap, (due, next(self.seq), data))
+        self.wakeup.set()
+
+    def close(self):
+        # Sends what is still scheduled, then stops
+        self.closed = True
+        self.wakeup.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        p = self.profile
+        while True:
+            if not self.heap:
+                if self.closed:
+                    return
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            delay = self.heap[0][0] - loop.time()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    # A new packet may be due earlier
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, data = heapq.heappop(self.heap)
+            split = p.split and len(data) > 1 and self.rng.random() < p.split
+            await self.send(data, split)
+            self.stats.packets += 1
+            self.stats.bytes += len(data)
+
+
+class ImpairmentProxy:
+    """
+    TCP or UDP proxy between mocks and the binary under test, running an
+    asyncio loop in a background thread. upstream impairs traffic from the
+    proxy's clients to target, downstream the way back. TCP streams are cut
+    into Data-/ControlPackets with PacketReader, UDP datagrams are impaired
+    as a whole. TCP directions without impairment forward raw bytes and only
+    count bytes, not packets.
+
+    Examples
+    ----------
+    > with ImpairmentProxy(("127.0.0.1", binary_port), upstream=Impairment(delay=0.05, loss=0.1, seed=1)) as proxy:
+    >     MockClient(packet, port=proxy.server_address[1]).run()
+    """
+    chunk_size = 1 << 18
+
+    def __init__(self, target, listen=("127.0.0.1", None), upstream=None, downstream=None, udp=False):
+        host, port = listen
+        if port is None:
+            port = lease_port()
+        self.target = target
+        self.upstream = upstream if upstream is not None else Impairment()
+        self.downstream = downstream if downstream is not None else Impairment()
+        self.udp = udp
+        self.upstream_stats = LinkStats()
+        self.downstream_stats = LinkStats()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM if udp else socket.SOCK_STREAM)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((host, port))
+            if not udp:
+                self.socket.listen(128)
+        except:
+            self.socket.close()
+            raise
+        self.server_address = self.socket.getsockname()
+        probes.track_port(self.server_address[1], udp=udp)
+
+        # Separate generators per direction keep a seeded run reproducible
+        self._rngs = (random.Random(self.upstream.seed), random.Random(self.downstream.seed))
+        self._loop = None
+        self._stop = None
+        self._thread = None
+        self._ready = threading.Event()
+        # Handlers of open TCP connections, cancelled on shutdown
+        self._tasks = set()
+
+    def start(self):
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def shutdown(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+            self._thread.join()
+            self._loop = None
+
+    def server_close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        if self.udp:
+            transport, listener = await self._loop.create_datagram_endpoint(
+                lambda: _UDPListener(self), sock=self.socket)
+            self._ready.set()
+            await self._stop.wait()
+            await listener.close()
+            transport.close()
+        else:
+            server = await asyncio.start_server(self._handle, sock=self.socket)
+            self._ready.set()
+            async with server:
+                await self._stop.wait()
+                for task in list(self._tasks):
+                    task.cancel()
+
+    async def _handle(self, client_reader, client_writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self._proxy(client_reader, client_writer)
+        except asyncio.CancelledError:
+            # Proxy shut down while the connection was still open
+            pass
+        finally:
+            self._tasks.discard(task)
+            client_writer.close()
+
+    async def _proxy(self, client_reader, client_writer):
+        try:
+            target_reader, target_writer = await asyncio.open_connection(*self.target)
+        except OSError as ex:
+            log.error(f"Proxy failed to connect to {self.target}: {ex}")
+            return
+
+        try:
+            await asyncio.gather(
+                self._pump(client_reader, target_writer, self.upstream, self._rngs[0], self.upstream_stats),
+                self._pump(target_reader, client_writer, self.downstream, self._rngs[1], self.downstream_stats))
+        except (OSError, asyncio.IncompleteReadError) as ex:
+            log.debug(f"Proxied connection closed: {ex}")
+        finally:
+            target_writer.close()
+
+    async def _pump(self, reader, writer, profile, rng, stats):
+        if not profile.active:
+            # Fast path, no framing
+            while data := await reader.read(self.chunk_size):
+                writer.write(data)
+                await writer.drain()
+                stats.bytes += len(data)
+        else:
+            async def send(data, split):
+                if split:
+                    half = len(data) // 2
+                    writer.write(data[:half])
+                    await writer.drain()
+                    await asyncio.sleep(profile.split_delay)
+                    data = data[half:]
+                writer.write(data)
+                await writer.drain()
+
+            link = _Link(profile, rng, stats, send)
+            sender = asyncio.ensure_future(link.run())
+            packets = PacketReader()
+            try:
+                while data := await reader.read(self.chunk_size):
+                    packets.feed(data)
+                    while (frame := packets.next_frame()) is not None:
+                        link.submit(frame)
+                    if sender.done():
+                        break
+            finally:
+                link.close()
+                await sender
+
+            if len(packets):
+                log.debug(f"Proxy discarded {len(packets)} bytes of an incomplete packet")
+
+        if writer.can_write_eof():
+            writer.write_eof()
+
+
+class _UDPListener(asyncio.DatagramProtocol):
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.transport = None
+        self.clients = {}
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        client = self.clients.get(addr)
+        if client is None:
+            client = self.clients[addr] = _UDPClient(self, addr)
+            task = asyncio.ensure_future(asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: client, remote_addr=tuple(self.proxy.target)))
+            # Keep a reference until done, the loop only holds weak ones
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        client.forward(data)
+
+    async def close(self):
+        """
+        Closes the sockets of all clients and cancels their links.
+        """
+        tasks = list(self.tasks)
+        for client in self.clients.values():
+            tasks += client.tasks
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for client in self.clients.values():
+            if client.transport is not None:
+                client.transport.close()
+        self.clients.clear()
+
+
+class _UDPClient(asyncio.DatagramProtocol):
+    """
+    Relays the datagrams of one client through its own socket to the
+    target, so replies can be mapped back.
+    """
+
+    def __init__(self, listener, addr):
+        proxy = listener.proxy
+        self.listener = listener
+        self.addr = addr
+        self.transport = None
+        self.pending = []
+        self.up = _Link(proxy.upstream, proxy._rngs[0], proxy.upstream_stats, self._send_up)
+        self.down = _Link(proxy.downstream, proxy._rngs[1], proxy.downstream_stats, self._send_down)
+        self.tasks = [asyncio.ensure_future(self.up.run()), asyncio.ensure_future(self.down.run())]
+
+    def connection_made(self, transport):
+        self.transport = transport
+        for data in self.pending:
+            self.forward(data)
+        self.pending = []
+
+    async def _send_up(self, data, split):
+        self.transport.sendto(data)
+
+    async def _send_down(self, data, split):
+        self.listener.transport.sendto(data, self.addr)
+
+    def forward(self, data):
+        if self.transport is None:
+            self.pending.append(data)
+        elif not self.up.profile.active:
+            self.transport.sendto(data)
+            self.up.stats.packets += 1
+            self.up.stats.bytes += len(data)
+        else:
+            self.up.submit(data)
+
+    def datagram_received(self, data, addr):
+        if not self.down.profile.active:
+            self.listener.transport.sendto(data, self.addr)
+            self.down.stats.packets += 1
+            self.down.stats.bytes += len(data)
+        else:
+            self.down.submit(data)
@@ -0,0 +1,276 @@
+import threading
+import itertools
+import bisect
+import random
+import select
+import socket
+import logging
+import time
+
+try:
+    from .packet import DataPacket, PacketReader
+except (ImportError, ModuleNotFoundError):
+    from packet import DataPacket, PacketReader
+
+log = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    """
+    HDR style histogram of integer values (nanoseconds). Every power of two is
+    split into 2^(precision-1) linear sub buckets, so the relative error is
+    bounded by 2^-(precision-1) over the whole range while memory stays small.
+    """
+
+    def __init__(self, precision=8):
+        self.precision = precision
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = max(value.bit_length() - self.precision, 0)
+        return (shift << self.precision) + (value >> shift)
+
+    def _highest_value(self, index):
+        shift = index >> self.precision
+        sub = index & ((1 << self.precision) - 1)
+        return ((sub + 1) << shift) - 1
+
+    def record(self, value):
+        value = int(value)
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.count > 0:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, q):
+        if self.count == 0:
+            return None
+
+        rank = max(1, round(q / 100 * self.count))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._highest_value(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class UniformKeys:
+    def __init__(self, n, rng):
+        self.n = n
+        self.rng = rng
+
+    def __call__(self):
+        return self.rng.randrange(self.n)
+
+
+class ZipfianKeys:
+    """
+    Picks key k (0 based) with probability proportional to 1 / (k+1)^s.
+    """
+
+    def __init__(self, n, rng, s=0.99):
+        self.rng = rng
+        self.cdf = list(itertools.accumulate(1.0 / (k + 1) ** s for k in range(n)))
+
+    def __call__(self):
+        return bisect.bisect(self.cdf, self.rng.random() * self.cdf[-1])
+
+
+KEY_DISTRIBUTIONS = {
+    'uniform': UniformKeys,
+    'zipfian': ZipfianKeys,
+}
+
+
+class LoadReport:
+    def __init__(self, histograms, errors, elapsed):
+        self.histograms = histograms
+        self.errors = errors
+        self.elapsed = elapsed
+
+        self.latency = LatencyHistogram()
+        for h in histograms.values():
+            self.latency.merge(h)
+
+    @property
+    def ops(self):
+        return self.latency.count
+
+    @property
+    def throughput(self):
+        return self.ops / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self):
+        def us(ns):
+            return None if ns is None else ns / 1000
+
+        return {
+            'ops': self.ops,
+            'errors': self.errors,
+            'elapsed': self.elapsed,
+            'ops_per_sec': self.throughput,
+            'p50_us': us(self.latency.percentile(50)),
+            'p99_us': us(self.latency.percentile(99)),
+            'p999_us': us(self.latency.percentile(99.9)),
+            'max_us': us(self.latency.max),
+            'methods': {m: h.count for m, h in self.histograms.items()},
+        }
+
+    def summary(self):
+        d = self.as_dict()
+        if self.ops == 0:
+            return f"0 ops in {d['elapsed']:.2f}s, {d['errors']} errors"
+        return (f"{d['ops']} ops in {d['elapsed']:.2f}s ({d['ops_per_sec']:.0f} ops/s), {d['errors']} errors, "
+                f"latency p50 {d['p50_us']:.0f}us p99 {d['p99_us']:.0f}us "
+                f"p999 {d['p999_us']:.0f}us max {d['max_us']:.0f}us")
+
+
+class LoadGenerator:
+    """
+    Drives GET/SET/DELETE DataPacket traffic against a binary and records
+    per request latency.
+
+    With rate set the load is open loop: request i is due at start + i/rate,
+    no matter how long earlier requests took, and its latency is measured from
+    that due time so queueing inside the binary is not hidden. Without rate
+    every worker sends its next request as soon as the previous one finished.
+    concurrency bounds the number of outstanding requests.
+
+    The protocol allows one request per connection; reuse_connections keeps
+    the connection open between requests of a worker for binaries that
+    support it.
+    """
+
+    def __init__(self, ip, port, rate=None, concurrency=1, duration=10.0, requests=None,
+                 mix=None, keys=1000, distribution='uniform', value_size=64,
+                 reuse_connections=False, timeout=3.0, seed=None):
+        self.ip = ip
+        self.port = port
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration
+        self.requests = requests
+        self.mix = mix if mix is not None else {'GET': 0.8, 'SET': 0.15, 'DELETE': 0.05}
+        self.keys = keys
+        self.distribution = distribution
+        self.value_size = value_size
+        self.reuse_connections = reuse_connections
+        self.timeout = timeout
+        self.seed = seed
+
+        if distribution not in KEY_DISTRIBUTIONS:
+            raise ValueError(f'Unknown key distribution {distribution}. Expected one of {list(KEY_DISTRIBUTIONS)}')
+
+    def _request(self, sock, packet):
+        """
+        Sends packet and waits for the response. Returns the connection to
+        reuse, or None. The connection is closed if the request fails.
+        """
+        if sock is None:
+            sock = socket.create_connection((self.ip, self.port), timeout=self.timeout)
+
+        try:
+            packet.write_to(sock)
+
+            reader = PacketReader()
+            response = reader.next_packet()
+            while response is None:
+                readable, _, _ = select.select([sock], [], [], self.timeout)
+                if sock not in readable:
+                    raise TimeoutError(f'No response to {packet.method} within {self.timeout}s')
+                if reader.read_from(sock) == 0:
+                    raise ConnectionError('Peer closed connection before responding')
+                response = reader.next_packet()
+        except BaseException:
+            sock.close()
+            raise
+
+        if not self.reuse_connections:
+            sock.close()
+            return None
+        return sock
+
+    def _worker(self, index, schedule, start, deadline, results):
+        rng = random.Random(None if self.seed is None else f"{self.seed}/{index}")
+        pick_key = KEY_DISTRIBUTIONS[self.distribution](self.keys, rng)
+        methods = list(self.mix)
+        weights = list(itertools.accumulate(self.mix[m] for m in methods))
+        value = rng.randbytes(self.value_size)
+
+        histograms = {m: LatencyHistogram() for m in methods}
+        errors = 0
+        sock = None
+
+        for i in schedule:
+            if self.requests is not None and i >= self.requests:
+                break
+
+            due = time.monotonic() if self.rate is None else start + i / self.rate
+            if due >= deadline:
+                break
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            method = methods[bisect.bisect(weights, rng.random() * weights[-1])]
+            key = b'key-%d' % pick_key()
+            packet = DataPacket(method, key, value if method == 'SET' else b'')
+
+            try:
+                sock = self._request(sock, packet)
+                histograms[method].record((time.monotonic() - due) * 1e9)
+            except (OSError, ValueError) as ex:
+                log.debug(f"Request failed: {ex}")
+                errors += 1
+                if sock is not None:
+                    sock.close()
+                sock = None
+
+        if sock is not None:
+            sock.close()
+        results[index] = (histograms, errors)
+
+    def run(self):
+        # Shared among workers, next() on itertools.count is atomic
+        schedule = itertools.count()
+        results = [None] * self.concurrency
+
+        start = time.monotonic()
+        deadline = start + self.duration if self.duration is not None else float('inf')
+        workers = [threading.Thread(target=self._worker, args=(i, schedule, start, deadline, results))
+                   for i in range(self.concurrency)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.monotonic() - start
+
+        histograms = {m: LatencyHistogram() for m in self.mix}
+        errors = 0
+        for worker_histograms, worker_errors in results:
+            errors += worker_errors
+            for m, h in worker_histograms.items():
+                histograms[m].merge(h)
+
+        report = LoadReport(histograms, errors, elapsed)
+        log.info(report.summary())
+        return report
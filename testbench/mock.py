@@ -1,5 +1,7 @@
 import socketserver
 import threading
+import collections
+import itertools
 import ipaddress
 import queue
 import sys
@@ -9,83 +11,243 @@ import logging
 import time
 
 try:
-    from .packet import Packet, ControlPacket, DataPacket, NTPPacket
+    from .packet import Packet, ControlPacket, DataPacket, NTPPacket, PacketReader
+    from .ports import lease_port
+    from . import probes
+    from . import recorder
+    from . import connpool
 except (ImportError, ModuleNotFoundError):
-    from packet import Packet, ControlPacket, DataPacket, NTPPacket
+    from packet import Packet, ControlPacket, DataPacket, NTPPacket, PacketReader
+    from ports import lease_port
+    import probes
+    import recorder
+    import connpool
 
 log = logging.getLogger(__name__)
 
-class MockServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    allow_reuse_address = True
+class PacketInbox:
+    """
+    Thread safe inbox for received packets. Packets are bucketed by
+    (type, method) so await_packet() returns the first packet matching a
+    type and filter no matter in which order packets arrived. Packets that
+    do not match stay in the inbox for later calls.
+
+    Also offers the queue.Queue interface (put/get/empty/qsize), get()
+    returns items in arrival order. Errors are put as sys.exc_info() tuples
+    and raised by the next await.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # (type, method) -> deque of (sequence number, packet)
+        self.buckets = {}
+        self.errors = collections.deque()
+        self.seq = itertools.count()
+
+    def put(self, item, block=True, timeout=None):
+        with self.cond:
+            if isinstance(item, tuple):
+                self.errors.append((next(self.seq), item))
+            else:
+                key = (type(item), getattr(item, 'method', None))
+                self.buckets.setdefault(key, collections.deque()).append((next(self.seq), item))
+            self.cond.notify_all()
+
+    def put_nowait(self, item):
+        self.put(item)
+
+    def qsize(self):
+        with self.cond:
+            return len(self.errors) + sum(len(b) for b in self.buckets.values())
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if not block:
+                timeout = 0
+            if not self.cond.wait_for(lambda: self._oldest() is not None, timeout):
+                raise queue.Empty
+            seq, bucket, i = self._oldest()
+            item = bucket[i][1]
+            del bucket[i]
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def _oldest(self):
+        heads = [(b[0][0], b, 0) for b in self.buckets.values() if b]
+        if self.errors:
+            heads.append((self.errors[0][0], self.errors, 0))
+        return min(heads, key=lambda h: h[0], default=None)
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.queue = queue.Queue()
-        self.resp_q = queue.Queue()
-        self.send_response = False
-        self.ip = "127.0.0.1"
+    @staticmethod
+    def _matches(packet, match):
+        if match is None:
+            return True
+        if callable(match):
+            return match(packet)
+        return all(getattr(packet, attr, None) == value for attr, value in match.items())
+
+    def _take(self, packet_type, match):
+        # Oldest packet of type packet_type (class or tuple of classes) for
+        # which match (dict of attribute values or predicate) holds
+        method = match.get('method') if isinstance(match, dict) else None
+        found = None
+        for (t, m), bucket in self.buckets.items():
+            if packet_type is not None and not issubclass(t, packet_type):
+                continue
+            if method is not None and m != method:
+                continue
+            for i, (seq, packet) in enumerate(bucket):
+                if self._matches(packet, match):
+                    if found is None or seq < found[0]:
+                        found = (seq, bucket, i)
+                    break
 
+        if found is None:
+            return None
+        seq, bucket, i = found
+        packet = bucket[i][1]
+        del bucket[i]
+        return packet
+
+    def _raise_error(self):
+        _, (err_type, value, tr) = self.errors.popleft()
+        raise AssertionError(
+            'Did not receive expected packet due to previous errors!') from value
+
+    def await_packet(self, packet_type=None, timeout=None, match=None):
+        """
+        Returns the first received packet of packet_type matching match, or
+        None after timeout seconds.
+
+        Examples
+        ----------
+        > server.await_packet(ControlPacket, 3, match={'method': 'STABILIZE'})
+        > server.await_packet(DataPacket, 3, match=lambda p: p.key == b'foo')
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                if self.errors:
+                    self._raise_error()
+                packet = self._take(packet_type, match)
+                if packet is not None:
+                    return packet
+
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                self.cond.wait(remaining)
+
+    def await_all(self, n, packet_type=None, timeout=None, match=None):
+        """
+        Returns n matching packets, or fewer if timeout expired before.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        packets = []
+        while len(packets) < n:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            packet = self.await_packet(packet_type, remaining, match)
+            if packet is None:
+                break
+            packets.append(packet)
+        return packets
+
+    def drain(self, packet_type=None, match=None):
+        """
+        Removes and returns all matching packets received so far in arrival order.
+        """
+        with self.cond:
+            if self.errors:
+                self._raise_error()
+            packets = []
+            while True:
+                packet = self._take(packet_type, match)
+                if packet is None:
+                    return packets
+                packets.append(packet)
+
+
+class MockQueueMixin:
+    """
+    Packet inbox handling shared by all mock servers. Handlers put received
+    packets (or sys.exc_info() tuples on errors) into self.queue, a PacketInbox.
+
+    Responses forwarded to another peer go through connpool.POOL. Set
+    persistent_connections to keep those connections open for reuse; the
+    default closes them after every packet, as peers expecting one packet
+    per connection require.
+
+    With session set, TCP handlers keep reading packets from a connection
+    until the peer closes it, answering each in order from resp_q.
+    """
+    persistent_connections = False
+    session = False
 
     def handle_error(self, request, client_address):
         self.queue.put(sys.exc_info())
 
-    def await_packet(self, packet_type, timeout):
-        try:
-            packet = self.queue.get(timeout=timeout)
-            if isinstance(packet, tuple):
-                # This is an error
-                err_type, value, tr = packet
-                raise AssertionError(
-                    'Did not receive expected packet due to previous errors!') from value
-
-            elif isinstance(packet, packet_type):
-                return packet
-            else:
-                ValueError(
-                    f'MockServer received unexpected packet type. Expected {packet_type} Got: {type(packet)}')
-        except queue.Empty:
-            return None
+    def await_packet(self, packet_type, timeout, match=None):
+        return self.queue.await_packet(packet_type, timeout, match)
+
+    def await_all(self, n, packet_type, timeout, match=None):
+        return self.queue.await_all(n, packet_type, timeout, match)
+
+    def drain(self, packet_type=None, match=None):
+        return self.queue.drain(packet_type, match)
 
 
-class MockServerUDP(socketserver.ThreadingMixIn, socketserver.UDPServer):
+class MockServer(MockQueueMixin, socketserver.ThreadingMixIn, socketserver.TCPServer):
     allow_reuse_address = True
-    response_timeout = 2.0
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.queue = queue.Queue()
+    def __init__(self, server_address, *args, **kwargs):
+        # A port of None leases a free one, see ports.lease_port
+        host, port = server_address
+        if port is None:
+            port = lease_port()
+        super().__init__((host, port), *args, **kwargs)
+        probes.track_port(self.server_address[1])
+        self.queue = PacketInbox()
         self.resp_q = queue.Queue()
         self.send_response = False
-
         self.ip = "127.0.0.1"
 
-    def handle_error(self, request, client_address):
-        self.queue.put(sys.exc_info())
 
-    def await_packet(self, packet_type, timeout):
-        try:
-            packet = self.queue.get(timeout=timeout)
-            if isinstance(packet, tuple):
-                # This is an error
-                err_type, value, tr = packet
-                raise AssertionError(
-                    'Did not receive expected packet due to previous errors!') from value
-
-            elif isinstance(packet, packet_type):
-                return packet
-            else:
-                ValueError(
-                    f'MockServer received unexpected packet type. Expected {packet_type} Got: {type(packet)}')
-        except queue.Empty:
-            return None
+class MockServerUDP(MockQueueMixin, socketserver.ThreadingMixIn, socketserver.UDPServer):
+    allow_reuse_address = True
+    response_timeout = 2.0
+
+    def __init__(self, server_address, *args, **kwargs):
+        host, port = server_address
+        if port is None:
+            port = lease_port()
+        super().__init__((host, port), *args, **kwargs)
+        probes.track_port(self.server_address[1], udp=True)
+        self.queue = PacketInbox()
+        self.resp_q = queue.Queue()
+        self.send_response = False
+
+        self.ip = "127.0.0.1"
 
 
 class MockClient:
-    def __init__(self, req: Packet, ip=None, port=1400):
+    def __init__(self, req: Packet, ip=None, port=None):
         self.running = False
-        self.queue = queue.Queue()
+        self.queue = PacketInbox()
         self.packet = req
         self.ip = ip
+        # A port of None leases a free one for the binary to listen on,
+        # see ports.lease_port
+        if port is None:
+            port = lease_port()
         self.port = port
         self.executing_thread = None
 
@@ -96,29 +258,69 @@ class MockClient:
         self.running = False
         self.executing_thread.join()
 
-    def await_packet(self, timeout):
+    def await_packet(self, timeout, match=None):
+        return self.queue.await_packet((DataPacket, ControlPacket), timeout, match)
+
+    @staticmethod
+    def expects_reply(packet):
+        # No response expected for lookup/reply messages
+        return not (isinstance(packet, ControlPacket) and packet.method in ['LOOKUP', 'REPLY', 'JOIN'])
+
+    def session(self, packets, timeout=3.0):
+        """
+        Sends packets back to back over one connection, then collects a reply
+        for every packet expecting one, in order. Replies are also put into
+        self.queue. Stops early once the peer closes the connection or sends
+        nothing for timeout seconds.
+
+        Examples
+        ----------
+        > replies = MockClient(None, port=port).session([DataPacket('GET', b'k%d' % i, b'') for i in range(100)])
+        """
+        self.running = True
+        self.executing_thread = threading.current_thread()
+        if not self.ip:
+            self.ip = "127.0.0.1"
+        expected = sum(1 for p in packets if self.expects_reply(p))
+        replies = []
+        reader = PacketReader()
+
+        sock = socket.create_connection((self.ip, self.port), timeout=3.0)
         try:
-            packet = self.queue.get(timeout=timeout)
-            if isinstance(packet, tuple):
-                # This is an error
-                err_type, value, tr = packet
-                raise AssertionError(
-                    'Did not receive expected packet due to previous errors!') from value
-            elif isinstance(packet, DataPacket):
-                return packet
-            elif isinstance(packet, ControlPacket):
-                return packet
-            else:
-                ValueError(
-                    f'MockClient received unexpected packet type. Expected DataPacket/CtrlPacket Got: {type(packet)}')
-        except queue.Empty:
-            return None
+            self.clientConnected.set()
+            sock.sendall(b''.join(p.serialize() for p in packets))
+            for p in packets:
+                recorder.record_socket(recorder.SENT, sock, p)
+
+            while self.running and len(replies) < expected:
+                frame = reader.next_frame()
+                if frame is None:
+                    readable, _, _ = select.select([sock], [], [], timeout)
+                    if sock not in readable or reader.read_from(sock) == 0:
+                        break
+                    continue
+
+                recorder.record_socket(recorder.RECEIVED, sock, frame)
+                try:
+                    reply = Packet.packet_type(frame).parse(frame)
+                except ValueError:
+                    self.queue.put(sys.exc_info())
+                    break
+                self.queue.put(reply)
+                replies.append(reply)
+        except OSError as e:
+            log.debug(f"Session ended: {e}")
+        finally:
+            sock.close()
+            self.running = False
+
+        return replies
 
     def run(self):
         self.running = True
         self.executing_thread = threading.current_thread()
         sock = socket.socket(type=socket.SOCK_STREAM)
-        reply = b''
+        reader = PacketReader()
 
         try:
             if not self.ip:
@@ -129,28 +331,34 @@ class MockClient:
             sock.connect((self.ip, self.port))
             self.clientConnected.set()
 
-            sock.sendall(self.packet.serialize())
+            self.packet.write_to(sock)
+            recorder.record_socket(recorder.SENT, sock, self.packet)
 
-            # No response expected for lookup/reply messages
-            if isinstance(self.packet, ControlPacket) and self.packet.method in ['LOOKUP', 'REPLY', 'JOIN']:
+            if not self.expects_reply(self.packet):
                 sock.close()
                 return
 
-            while self.running:
-                readable, _, _ = select.select([sock], [], [], 1.0)
-
-                if not sock in readable:
-                    break
-
-                data = sock.recv(1000)
-
-                if not data:
-                    break
-
-                reply += data
             try:
-                # Packet response type depends on sent message
-                response = self.packet.__class__.parse(reply)
+                response = None
+                while self.running and response is None:
+                    readable, _, _ = select.select([sock], [], [], 1.0)
+
+                    if not sock in readable:
+                        break
+
+                    if reader.read_from(sock) == 0:
+                        break
+
+                    frame = reader.next_frame()
+                    if frame is not None:
+                        recorder.record_socket(recorder.RECEIVED, sock, frame)
+                        response = Packet.packet_type(frame).parse(frame)
+
+                if response is None:
+                    # Packet response type depends on sent message
+                    if len(reader):
+                        recorder.record_socket(recorder.RECEIVED, sock, reader.pending())
+                    response = self.packet.__class__.parse(reader.pending())
                 self.queue.put(response)
             except ValueError:
                 self.queue.put(sys.exc_info())
@@ -166,91 +374,89 @@ class GeneralPktHandler(socketserver.StreamRequestHandler):
         try:
             packet = self.server.resp_q.get(timeout=2.0)
             if isinstance(packet, Packet):
-                buffer = packet.serialize()
-                self.wfile.write(buffer)
+                packet.write_to(self.connection)
+                recorder.record_socket(recorder.SENT, self.connection, packet)
             else:
                 p, host, port = packet
-                self._connect_and_send(p, host, port)
+                self._connect_and_send(p, host, port, self.server.persistent_connections)
 
         except queue.Empty:
             raise RuntimeError(
                 'Expected response packet in queue! This should not happen!')
 
     @staticmethod
-    def _connect_and_send(p, host, port):
+    def _connect_and_send(p, host, port, persistent=False):
         log = logging.getLogger(__name__)
-        sock = socket.socket(type=socket.SOCK_STREAM)
         try:
             log.debug(f"Sending to {host}:{port}")
-            sock.settimeout(3.0)
-            sock.connect((host, port))
-            sock.sendall(p.serialize())
+            connpool.POOL.send(p, host, port, persistent,
+                               lambda sock: recorder.record_socket(recorder.SENT, sock, p))
             log.debug('Sent successfully')
         except Exception as e:
             log.error(e)
-        finally:
-            sock.close()
 
-    def handle_ctrl_packet(self, data):
-        while len(data) < 11:
-            readable, _, _ = select.select([self.rfile], [], [], 3.0)
-            if self.rfile in readable:
-                chunk = self.rfile.read1(11)
-                if not chunk:
-                    break
-                data += chunk
-            else:
-                raise ValueError("Peer did not send full Control packet")
+    def setup(self):
+        super().setup()
+        self.reader = PacketReader()
 
-            packet = ControlPacket.parse(data)
-            self.server.queue.put(packet)
+    def read_packet(self, error):
+        frame = self.reader.next_frame()
+        while frame is None:
+            readable, _, _ = select.select([self.connection], [], [], 3.0)
+            if self.connection not in readable:
+                raise ValueError(error)
+            if self.reader.read_from(self.connection) == 0:
+                raise ValueError(error)
+            frame = self.reader.next_frame()
 
-    def handle_data_packet(self, data):
-        while len(data) < 7:
-            readable, _, _ = select.select([self.rfile], [], [], 3.0)
-            if self.rfile in readable:
-                chunk = self.rfile.read1(7)
-                if not chunk:
-                    break
-                data += chunk
-            else:
-                break
-
-        if len(data) < 7:
-            raise ValueError(
-                'Peer did not send enough bytes to parse a data/client packet header')
+        recorder.record_socket(recorder.RECEIVED, self.connection, frame)
+        return Packet.packet_type(frame).parse(frame)
 
-        key_len, value_len = DataPacket.len_from_header(data)
-
-        while len(data) < 7 + key_len + value_len:
-            readable, _, _ = select.select([self.rfile], [], [], 3.0)
-            if self.rfile in readable:
-                chunk = self.rfile.read1(1)
-                if not chunk:
-                    break
-                data += chunk
-            else:
-                break
+    def handle_ctrl_packet(self, data):
+        packet = self.read_packet("Peer did not send full Control packet")
+        self.server.queue.put(packet)
 
-        packet = DataPacket.parse(data)
+    def handle_data_packet(self, data):
+        packet = self.read_packet(
+            'Peer did not send enough bytes to parse a data/client packet')
         self.server.queue.put(packet)
 
     def get_first_byte(self):
-        data = b''
-        readable, _, _ = select.select([self.rfile], [], [], 3.0)
-
-        if self.rfile not in readable:
-            raise ValueError(
-                "Peer did not send a single byte to determine packet type!")
-
-        data += self.rfile.read1(1)
-        if len(data) == 0:
-            raise ValueError(
-                "Peer did not send a single byte to determine packet type!")
-
-        return data
+        # The byte stays buffered in self.reader for the packet handlers
+        if len(self.reader) == 0:
+            readable, _, _ = select.select([self.connection], [], [], 3.0)
+
+            if self.connection not in readable:
+                raise ValueError(
+                    "Peer did not send a single byte to determine packet type!")
+
+            if self.reader.read_from(self.connection) == 0:
+                raise ValueError(
+                    "Peer did not send a single byte to determine packet type!")
+
+        return self.reader.peek(1)
+
+    def next_request(self):
+        """
+        Session mode: True when the peer sent (part of) another packet,
+        False once it closed the connection or stayed idle for 3 s.
+        """
+        if len(self.reader):
+            return True
+        readable, _, _ = select.select([self.connection], [], [], 3.0)
+        if self.connection not in readable:
+            return False
+        try:
+            return self.reader.read_from(self.connection) > 0
+        except ConnectionResetError:
+            return False
 
     def handle(self):
+        self.handle_request()
+        while self.server.session and self.next_request():
+            self.handle_request()
+
+    def handle_request(self):
         data = self.get_first_byte()
         if Packet.packet_type(data) == ControlPacket:
             self.handle_ctrl_packet(data)
@@ -258,12 +464,11 @@ class GeneralPktHandler(socketserver.StreamRequestHandler):
             self.handle_data_packet(data)
 
         if self.server.send_response:
-            time.sleep(0.1)
             self.send_response()
 
 
 class ControlPktHandler(GeneralPktHandler):
-    def handle(self):
+    def handle_request(self):
         data = self.get_first_byte()
         if not Packet.packet_type(data) == ControlPacket:
             raise ValueError(
@@ -275,7 +480,7 @@ class ControlPktHandler(GeneralPktHandler):
 
 
 class DataPktHandler(GeneralPktHandler):
-    def handle(self):
+    def handle_request(self):
         data = self.get_first_byte()
         if not Packet.packet_type(data) == DataPacket:
             raise ValueError(
@@ -288,6 +493,7 @@ class DataPktHandler(GeneralPktHandler):
 
 class NTPPktHandler(socketserver.DatagramRequestHandler):
     def handle(self):
+        recorder.record_socket(recorder.RECEIVED, self.socket, self.packet, self.client_address)
         packet = NTPPacket.parse(self.packet)
         self.server.queue.put(packet)
 
@@ -305,9 +511,10 @@ class NTPPktHandler(socketserver.DatagramRequestHandler):
             if isinstance(packet, Packet):
                 buffer = packet.serialize()
                 self.socket.sendto(buffer, self.client_address)
+                recorder.record_socket(recorder.SENT, self.socket, buffer, self.client_address)
             else:
                 p, host, port = packet
-                GeneralPktHandler.connect_and_send(p, host, port)
+                GeneralPktHandler._connect_and_send(p, host, port, self.server.persistent_connections)
 
         except queue.Empty:
             raise RuntimeError(
@@ -0,0 +1,197 @@
+import array
+import math
+import statistics
+
+try:
+    from .packet import NTPColumns
+except (ImportError, ModuleNotFoundError):
+    from packet import NTPColumns
+
+# All times are NTP 32.32 fixed point integers, differences signed 64 bit
+ONE_SECOND = 1 << 32
+MASK64 = (1 << 64) - 1
+
+# Frequency tolerance (15 ppm), RFC 5905 PHI
+PHI_PPM = 15
+# Dispersion of empty filter stages (16 s), RFC 5905 MAXDISP
+MAXDISP = 16 * ONE_SECOND
+FILTER_WINDOW = 8
+
+
+def diff(a, b):
+    """
+    a - b of two NTP timestamps as signed 64 bit value, correct across the
+    era wrap as long as both are less than 68 years apart.
+    """
+    d = (a - b) & MASK64
+    return d - (1 << 64) if d >> 63 else d
+
+
+def to_seconds(value):
+    return value / ONE_SECOND
+
+
+def from_seconds(seconds):
+    return round(seconds * ONE_SECOND)
+
+
+class NTPSamples:
+    """
+    Offset, round trip delay and dispersion of a batch of client/server
+    exchanges as signed 32.32 fixed point columns (array 'q').
+
+    For every exchange t1 is the client transmit time (origin timestamp of
+    the response), t2/t3 the server receive/transmit time and t4 the local
+    receive time:
+
+        offset = ((t2 - t1) + (t3 - t4)) / 2
+        delay = (t4 - t1) - (t3 - t2)
+        dispersion = precision + PHI * (t4 - t1)
+    """
+
+    def __init__(self, t1, t2, t3, t4, precision=-20):
+        self.t4 = array.array('Q', t4)
+        self.offset = array.array('q')
+        self.delay = array.array('q')
+        self.dispersion = array.array('q')
+
+        rho = from_seconds(2.0 ** precision)
+        for a, b, c, d in zip(t1, t2, t3, t4):
+            self.offset.append((diff(b, a) + diff(c, d)) >> 1)
+            self.delay.append(max(diff(d, a) - diff(c, b), 0))
+            self.dispersion.append(rho + diff(d, a) * PHI_PPM // 1_000_000)
+
+    def __len__(self):
+        return len(self.offset)
+
+    @classmethod
+    def from_exchanges(cls, responses, local_recv, precision=-20):
+        """
+        responses are NTPPackets or the NTPColumns of NTPPacket.parse_many(),
+        local_recv the matching local receive times as 32.32 fixed point.
+        """
+        if isinstance(responses, NTPColumns):
+            return cls(responses.origin_ts, responses.recv_ts, responses.transmit_ts, local_recv, precision)
+
+        return cls([p.origin_ts.to_fixed() for p in responses], [p.recv_ts.to_fixed() for p in responses],
+                   [p.transmit_ts.to_fixed() for p in responses], local_recv, precision)
+
+    def stats(self, column='offset'):
+        """
+        Mean, standard deviation, min, median and max of a column in seconds.
+        """
+        values = [to_seconds(v) for v in getattr(self, column)]
+        return {
+            'mean': statistics.fmean(values),
+            'stdev': statistics.pstdev(values),
+            'min': min(values),
+            'median': statistics.median(values),
+            'max': max(values),
+        }
+
+
+class FilterResult:
+    def __init__(self):
+        self.offset = array.array('q')
+        self.delay = array.array('q')
+        self.dispersion = array.array('q')
+        self.jitter = array.array('q')
+
+    def __len__(self):
+        return len(self.offset)
+
+
+def clock_filter(samples, window=FILTER_WINDOW):
+    """
+    RFC 5905 clock filter over the sample stream. For every new sample the
+    window of the last `window` samples is aged by PHI, the sample with the
+    lowest delay is selected and the filter dispersion and jitter are
+    computed from the window sorted by delay. Returns the estimate after
+    every sample.
+    """
+    result = FilterResult()
+    # (delay, offset, dispersion, t4) of the last samples, newest first.
+    # Dispersion is aged by PHI * (now - t4) when the window is evaluated.
+    stages = []
+    weights = range(1, window + 1)
+    empty = 0
+
+    for offset, delay, disp, t in zip(samples.offset, samples.delay, samples.dispersion, samples.t4):
+        stages.insert(0, (delay, offset, disp, t))
+        if len(stages) > window:
+            stages.pop()
+        else:
+            # Stages not filled yet count with MAXDISP
+            empty = sum(MAXDISP >> i for i in range(len(stages) + 1, window + 1))
+
+        by_delay = sorted(stages)
+        best_delay, best_offset = by_delay[0][0], by_delay[0][1]
+
+        dispersion = empty
+        for i, (_, _, stage_disp, stage_t) in zip(weights, by_delay):
+            dispersion += (stage_disp + diff(t, stage_t) * PHI_PPM // 1_000_000) >> i
+
+        jitter = 0
+        if len(by_delay) > 1:
+            # RMS in floats, relative precision is plenty for a jitter
+            squares = sum(float(s[1] - best_offset) ** 2 for s in by_delay[1:])
+            jitter = round(math.sqrt(squares / (len(by_delay) - 1)))
+
+        result.offset.append(best_offset)
+        result.delay.append(best_delay)
+        result.dispersion.append(dispersion)
+        result.jitter.append(jitter)
+
+    return result
+
+
+def root_distance(delay, dispersion, root_delay=0, root_dispersion=0):
+    return (delay + root_delay) // 2 + dispersion + root_dispersion
+
+
+def select(offsets, distances):
+    """
+    RFC 5905 selection (Marzullo's intersection) over the estimates of
+    several servers. Each server claims the true time lies within
+    offset +- distance; the smallest interval agreed on by a majority is
+    searched. Returns (low, high, truechimers) with the indices of the
+    servers whose interval overlaps it, or None without a majority.
+    """
+    n = len(offsets)
+    # (edge, type) with +1 for low ends, 0 for midpoints and -1 for high ends
+    edges = []
+    for o, r in zip(offsets, distances):
+        edges += [(o - r, 1), (o, 0), (o + r, -1)]
+    # At equal edges low ends come first so touching intervals intersect
+    edges.sort(key=lambda e: (e[0], -e[1]))
+
+    allow = 0
+    while 2 * allow < n:
+        found = 0
+        chime = 0
+        low = None
+        for edge, kind in edges:
+            chime += kind
+            if chime >= n - allow:
+                low = edge
+                break
+            if kind == 0:
+                found += 1
+
+        chime = 0
+        high = None
+        for edge, kind in reversed(edges):
+            chime -= kind
+            if chime >= n - allow:
+                high = edge
+                break
+            if kind == 0:
+                found += 1
+
+        if found <= allow and low is not None and high is not None and low <= high:
+            truechimers = [i for i, (o, r) in enumerate(zip(offsets, distances))
+                           if o - r <= high and o + r >= low]
+            return low, high, truechimers
+        allow += 1
+
+    return None
@@ -0,0 +1,214 @@
+import datetime
+import threading
+import itertools
+import heapq
+import selectors
+import random
+import socket
+import struct
+import logging
+import time
+import os
+
+try:
+    from .packet import NTPPacket, NTPShort, NTPTimestamp
+    from .ports import lease_port
+    from . import probes
+except (ImportError, ModuleNotFoundError):
+    from packet import NTPPacket, NTPShort, NTPTimestamp
+    from ports import lease_port
+    import probes
+
+log = logging.getLogger(__name__)
+
+# origin, receive and transmit timestamp at their offsets in the packet
+TIMESTAMPS = struct.Struct('>8sQQ')
+TIMESTAMPS_OFFSET = 24
+
+
+class NTPProfile:
+    """
+    Clock behaviour of an NTPResponder: a constant offset in seconds plus
+    drift (in ppm since the responder started) and uniform jitter of
+    +-jitter seconds. delay is the processing time: replies are held back
+    until delay seconds after the request was received, and stamped with
+    the time they are actually sent. dispersion is the advertised root
+    dispersion.
+    """
+
+    def __init__(self, offset=0.0, drift=0.0, jitter=0.0, delay=0.0, dispersion=0.0, stratum=1, seed=None):
+        self.offset = offset
+        self.drift = drift
+        self.jitter = jitter
+        self.delay = delay
+        self.dispersion = dispersion
+        self.stratum = stratum
+        self.rng = random.Random(seed)
+        self.start_ns = time.time_ns()
+
+    def offset_ns(self, now_ns):
+        offset = self.offset + (now_ns - self.start_ns) * self.drift * 1e-15
+        if self.jitter:
+            offset += self.rng.uniform(-self.jitter, self.jitter)
+        return int(offset * 1e9)
+
+    def root_dispersion(self):
+        seconds = int(self.dispersion)
+        return NTPShort(seconds, int((self.dispersion - seconds) * (1 << 16)))
+
+
+class NTPResponder:
+    """
+    High rate NTP server for load tests. Instead of taking a response per
+    request from resp_q it answers every client request from a prebuilt
+    48 byte server template, patching only the origin, receive and transmit
+    timestamps according to profile.
+
+    Each worker owns a non-blocking socket bound with SO_REUSEPORT to the
+    same address and drains it in batches of up to batch datagrams before
+    answering them. The kernel spreads clients over the sockets.
+
+    Examples
+    ----------
+    > with NTPResponder(("127.0.0.1", None), NTPProfile(offset=0.25), workers=4) as ntp:
+    >     exec_async([binary, "{port}"], ports={"port": ntp.server_address[1]})
+    """
+
+    def __init__(self, server_address, profile=None, workers=1, batch=64):
+        host, port = server_address
+        if port is None:
+            port = lease_port()
+        self.profile = profile if profile is not None else NTPProfile()
+        self.batch = batch
+        self.ip = "127.0.0.1"
+
+        self.sockets = []
+        try:
+            for _ in range(workers):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                if workers > 1:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                sock.bind((host, port))
+                sock.setblocking(False)
+                self.sockets.append(sock)
+                # An ephemeral port is only picked by the first bind
+                host, port = sock.getsockname()
+        except:
+            self.server_close()
+            raise
+        self.server_address = (host, port)
+        probes.track_port(port, udp=True)
+
+        template = NTPPacket.from_datetime(datetime.datetime.now(), datetime.timedelta(0),
+                                           self.profile.root_dispersion())
+        template.stratum = self.profile.stratum
+        self.template = bytes(template.serialize())
+
+        # Answered and dropped requests per worker
+        self.answered = [0] * workers
+        self.dropped = [0] * workers
+
+        self._threads = []
+        self._wakeup_r, self._wakeup_w = os.pipe()
+
+    @property
+    def requests(self):
+        return sum(self.answered)
+
+    def _worker(self, index, sock):
+        response = bytearray(self.template)
+        buffers = [bytearray(512) for _ in range(self.batch)]
+        received = [None] * self.batch
+        profile = self.profile
+        delay_ns = int(profile.delay * 1e9)
+        # Replies held back by profile.delay: (due time, seq, addr, origin, recv_ts, offset)
+        delayed = []
+        seq = itertools.count()
+
+        def send(addr, origin, recv_ts, offset):
+            transmit_ts = NTPTimestamp.fixed_from_ns(time.time_ns() + offset)
+            TIMESTAMPS.pack_into(response, TIMESTAMPS_OFFSET, origin, recv_ts, transmit_ts)
+            try:
+                sock.sendto(response, addr)
+                self.answered[index] += 1
+            except OSError as ex:
+                log.debug(f"Failed to answer {addr}: {ex}")
+                self.dropped[index] += 1
+
+        sel = selectors.DefaultSelector()
+        sel.register(sock, selectors.EVENT_READ)
+        sel.register(self._wakeup_r, selectors.EVENT_READ)
+        try:
+            while True:
+                timeout = None
+                if delayed:
+                    timeout = max(delayed[0][0] - time.time_ns(), 0) / 1e9
+                events = sel.select(timeout)
+                if any(key.fd == self._wakeup_r for key, _ in events):
+                    return
+
+                now = time.time_ns()
+                while delayed and delayed[0][0] <= now:
+                    _, _, addr, origin, recv_ts, offset = heapq.heappop(delayed)
+                    send(addr, origin, recv_ts, offset)
+
+                # Drain up to batch datagrams, then answer them all
+                n = 0
+                while n < self.batch:
+                    try:
+                        nbytes, addr = sock.recvfrom_into(buffers[n])
+                    except BlockingIOError:
+                        break
+                    received[n] = (nbytes, addr, time.time_ns())
+                    n += 1
+
+                for i in range(n):
+                    nbytes, addr, recv_ns = received[i]
+                    request = buffers[i]
+                    if nbytes < 48 or request[0] & 0b111 != NTPPacket.MODE_CLIENT:
+                        self.dropped[index] += 1
+                        continue
+
+                    offset = profile.offset_ns(recv_ns)
+                    recv_ts = NTPTimestamp.fixed_from_ns(recv_ns + offset)
+                    if delay_ns:
+                        heapq.heappush(delayed, (recv_ns + delay_ns, next(seq), addr, bytes(request[40:48]),
+                                                 recv_ts, offset))
+                    else:
+                        send(addr, request[40:48], recv_ts, offset)
+        finally:
+            sel.close()
+
+    def start(self):
+        for i, sock in enumerate(self.sockets):
+            t = threading.Thread(target=self._worker, args=(i, sock), daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def serve_forever(self):
+        self.start()
+        for t in self._threads:
+            t.join()
+
+    def shutdown(self):
+        if self._wakeup_w is not None:
+            os.write(self._wakeup_w, b'\0')
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def server_close(self):
+        for sock in self.sockets:
+            sock.close()
+        if getattr(self, '_wakeup_w', None) is not None:
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            self._wakeup_r = self._wakeup_w = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -1,8 +1,23 @@
 import ipaddress
+import struct
+import array
+import collections
+import mmap
+import os
 
 import datetime
 
 
+# Column layout returned by the batch codecs (parse_many/serialize_many)
+ControlColumns = collections.namedtuple(
+    'ControlColumns', ['method', 'hash_id', 'node_id', 'ip', 'port'])
+
+NTPColumns = collections.namedtuple(
+    'NTPColumns', ['li', 'version', 'mode', 'stratum', 'poll', 'precision',
+                   'root_delay', 'root_dispersion', 'reference_id',
+                   'reference_ts', 'origin_ts', 'recv_ts', 'transmit_ts'])
+
+
 class Packet:
     @classmethod
     def parse(cls, buffer):
@@ -11,6 +26,15 @@ class Packet:
     def serialize(self):
         raise NotImplementedError()
 
+    def serialize_parts(self):
+        return [self.serialize()]
+
+    def write_to(self, sock):
+        """
+        Sends the serialized packet on a connected stream socket.
+        """
+        sendmsg_all(sock, self.serialize_parts())
+
     @staticmethod
     def packet_type(buffer):
         if len(buffer) == 0:
@@ -22,6 +46,45 @@ class Packet:
             return DataPacket
 
 
+def sendmsg_all(sock, buffers):
+    """
+    Like sock.sendall() for a list of buffers, sent with scatter-gather I/O.
+    """
+    views = [memoryview(b).cast('B') for b in buffers if len(b) > 0]
+    while views:
+        sent = sock.sendmsg(views)
+        while sent > 0:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+class FileValue:
+    """
+    DataPacket value backed by a region of a file. DataPacket.write_to()
+    streams it with sendfile so it is never loaded into Python memory.
+    """
+
+    def __init__(self, path, offset=0, length=None):
+        self.path = path
+        self.offset = offset
+        if length is None:
+            length = os.path.getsize(path) - offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def map(self):
+        if self.length == 0:
+            return b''
+        with open(self.path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped)[self.offset:self.offset + self.length]
+
+
 class NullPacket(Packet):
     def serialize(self):
         return b''
@@ -51,22 +114,8 @@ class DataPacket(Packet):
 
         return key_len, value_len
 
-    @classmethod
-    def parse(cls, buffer):
-        key_len, value_len = cls.len_from_header(buffer)
-        if len(buffer) < 7 + key_len + value_len:
-            raise ValueError('Received Packet too short!')
-
-        if key_len > 0:
-            key = buffer[7:7 + key_len]
-        else:
-            key = b''
-
-        if value_len > 0:
-            value = buffer[7 + key_len:7 + key_len + value_len]
-        else:
-            value = b''
-
+    @staticmethod
+    def flags_from_header(buffer):
         del_set = (buffer[0] & (1 << 0)) >> 0
         set_set = (buffer[0] & (1 << 1)) >> 1
         get_set = (buffer[0] & (1 << 2)) >> 2
@@ -91,10 +140,29 @@ class DataPacket(Packet):
         else:
             raise ValueError('No method set in Flag bits!')
 
-        return cls(method=method, key=key, value=value, ack=(ack_set == 1))
+        return method, (ack_set == 1)
 
-    def serialize(self):
-        p = bytearray(7 + len(self.key) + len(self.value))
+    @classmethod
+    def parse(cls, buffer):
+        key_len, value_len = cls.len_from_header(buffer)
+        if len(buffer) < 7 + key_len + value_len:
+            raise ValueError('Received Packet too short!')
+
+        if key_len > 0:
+            key = buffer[7:7 + key_len]
+        else:
+            key = b''
+
+        if value_len > 0:
+            value = buffer[7 + key_len:7 + key_len + value_len]
+        else:
+            value = b''
+
+        method, ack = cls.flags_from_header(buffer)
+        return cls(method=method, key=key, value=value, ack=ack)
+
+    def header(self):
+        p = bytearray(7)
         if self.method == 'GET':
             p[0] |= 1 << 2
         elif self.method == 'SET':
@@ -117,15 +185,103 @@ class DataPacket(Packet):
         p[5] = (value_len >> 8) & 0xFF
         p[6] = (value_len >> 0) & 0xFF
 
-        if key_len > 0:
-            p[7:7 + key_len] = self.key
-        if value_len > 0:
-            p[7 + key_len:7 + key_len + value_len] = self.value
+        return p
+
+    def serialize_parts(self):
+        """
+        Returns header, key and value as separate buffers without copying them.
+        A FileValue is memory mapped.
+        """
+        value = self.value.map() if isinstance(self.value, FileValue) else self.value
+        return [self.header(), self.key, value]
 
+    def serialize(self):
+        p, key, value = self.serialize_parts()
+        p += key
+        p += value
         return p
 
+    def write_to(self, sock):
+        if isinstance(self.value, FileValue):
+            sendmsg_all(sock, [self.header(), self.key])
+            # Goes straight from the page cache to the socket
+            with open(self.value.path, 'rb') as f:
+                sock.sendfile(f, self.value.offset, len(self.value))
+        else:
+            sendmsg_all(sock, self.serialize_parts())
+
+
+class LazyDataPacket(DataPacket):
+    """
+    DataPacket whose key and value are memoryviews into the receive buffer
+    instead of copies, so multi megabyte values are never duplicated.
+    Method and ack flags are decoded on first access.
+
+    Comparing key/value to bytes works as usual, use bytes(p.value) for a copy.
+    """
+
+    def __init__(self, buffer):
+        buffer = memoryview(buffer)
+        key_len, value_len = self.len_from_header(buffer)
+        if len(buffer) < 7 + key_len + value_len:
+            raise ValueError('Received Packet too short!')
+
+        self.buffer = buffer[:7 + key_len + value_len]
+        self.key = self.buffer[7:7 + key_len]
+        self.value = self.buffer[7 + key_len:]
+        self._flags = None
+
+    @classmethod
+    def parse(cls, buffer):
+        return cls(buffer)
+
+    @classmethod
+    def from_file(cls, path, offset=0):
+        """
+        Maps a serialized packet from a file instead of reading it into memory.
+        """
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(memoryview(mapped)[offset:])
+
+    def _decoded_flags(self):
+        if self._flags is None:
+            method, ack = self.flags_from_header(self.buffer)
+            self._flags = [method, ack]
+        return self._flags
+
+    @property
+    def method(self):
+        return self._decoded_flags()[0]
+
+    @method.setter
+    def method(self, method):
+        self._decoded_flags()[0] = method
+
+    @property
+    def ack(self):
+        return self._decoded_flags()[1]
+
+    @ack.setter
+    def ack(self, ack):
+        self._decoded_flags()[1] = ack
+
+    def release(self):
+        """
+        Releases the views so the underlying buffer or mapping can be closed.
+        """
+        self.key.release()
+        self.value.release()
+        self.buffer.release()
+
 
 class ControlPacket(Packet):
+    # Method bits in the order parse() checks them
+    METHOD_BITS = [('REPLY', 1), ('LOOKUP', 0), ('STABILIZE', 2), ('NOTIFY', 3),
+                   ('JOIN', 4), ('FACK', 5), ('FINGER', 6)]
+
+    RECORD = struct.Struct('>BHHIH')
+
     def __init__(self, method: str, hash_id: int, node_id: int, node_ip: ipaddress.IPv4Address, node_port: int):
         self.hash_id = hash_id
         self.node_id = node_id
@@ -203,6 +359,199 @@ class ControlPacket(Packet):
         p.raw = buffer
         return p
 
+    @classmethod
+    def _method_table(cls):
+        # Flag byte -> method name, None if the byte is not a valid control header
+        if '_methods' not in cls.__dict__:
+            table = [None] * 256
+            for flags in range(1 << 7, 1 << 8):
+                for method, bit in cls.METHOD_BITS:
+                    if flags & (1 << bit):
+                        table[flags] = method
+                        break
+            cls._methods = table
+        return cls._methods
+
+    @classmethod
+    def serialize_many(cls, method, hash_id, node_id, ip, port):
+        """
+        Encodes columns of control packets into one buffer of 11 byte records.
+        ip may hold IPv4Address objects or their integer value.
+        """
+        try:
+            flags = [(1 << 7) | (1 << bit) for bit in map(dict(cls.METHOD_BITS).__getitem__, method)]
+        except KeyError:
+            raise RuntimeError('Unrecognized method for control packet! Cannot serialize!')
+
+        return b''.join(map(cls.RECORD.pack, flags, hash_id, node_id, map(int, ip), port))
+
+    @classmethod
+    def parse_many(cls, buffer):
+        """
+        Decodes a buffer of back to back control packets into ControlColumns.
+        The ip column holds the addresses as integers.
+        """
+        if len(buffer) % cls.RECORD.size != 0:
+            raise ValueError('Buffer is not a multiple of the Control packet size!')
+        if len(buffer) == 0:
+            return ControlColumns([], array.array('H'), array.array('H'), array.array('I'), array.array('H'))
+
+        flags, hash_id, node_id, ip, port = zip(*cls.RECORD.iter_unpack(buffer))
+        method = list(map(cls._method_table().__getitem__, flags))
+        if None in method:
+            raise ValueError('Invalid flags in Control packet batch!')
+
+        return ControlColumns(method, array.array('H', hash_id), array.array('H', node_id),
+                              array.array('I', ip), array.array('H', port))
+
+
+class PacketReader:
+    """
+    Incremental framing parser for a stream of Data- and ControlPackets.
+
+    Bytes are received straight into a preallocated buffer (free_space/commit
+    or read_from) or copied in with feed(). The packet type is decided by the
+    first byte and the frame length by the header, so complete packets are
+    cut out of the buffer without any per byte reads or concatenation.
+
+    With lazy=True DataPackets are returned as LazyDataPacket views into the
+    receive buffer, which is then handed over to the packet.
+    """
+
+    def __init__(self, size=4096, lazy=False):
+        self._size = size
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+        self.lazy = lazy
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __iter__(self):
+        packet = self.next_packet()
+        while packet is not None:
+            yield packet
+            packet = self.next_packet()
+
+    def frame_len(self):
+        """
+        Returns the length of the next frame or None if the header is incomplete.
+        """
+        pending = self._end - self._start
+        if pending == 0:
+            return None
+
+        header = memoryview(self._buf)[self._start:self._start + min(pending, 7)]
+        if Packet.packet_type(header) == ControlPacket:
+            return 11
+        if pending < 7:
+            return None
+
+        key_len, value_len = DataPacket.len_from_header(header)
+        return 7 + key_len + value_len
+
+    def needed(self):
+        """
+        Returns the minimum number of bytes still missing for the next frame.
+        """
+        pending = self._end - self._start
+        if pending == 0:
+            return 1
+
+        frame_len = self.frame_len()
+        if frame_len is None:
+            # Only a data packet header can be incomplete
+            return 7 - pending
+        return max(frame_len - pending, 0)
+
+    def _reserve(self, size):
+        if len(self._buf) - self._end >= size:
+            return
+
+        pending = self._end - self._start
+        if len(self._buf) - pending >= size:
+            # Move the unconsumed tail to the front
+            self._buf[:pending] = self._buf[self._start:self._end]
+        else:
+            buf = bytearray(max(pending + size, 2 * len(self._buf)))
+            buf[:pending] = memoryview(self._buf)[self._start:self._end]
+            self._buf = buf
+        self._start = 0
+        self._end = pending
+
+    def free_space(self, size=None):
+        """
+        Returns a writable view for recv_into()/readinto(). Large enough to
+        hold the rest of the current frame in a single call.
+        """
+        if size is None:
+            size = max(self.needed(), 4096)
+        self._reserve(size)
+        return memoryview(self._buf)[self._end:]
+
+    def commit(self, n):
+        self._end += n
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def read_from(self, sock):
+        """
+        Receives once from sock into the buffer. Returns 0 on EOF.
+        """
+        with self.free_space() as view:
+            n = sock.recv_into(view)
+        self.commit(n)
+        return n
+
+    def peek(self, n):
+        return bytes(self._buf[self._start:self._start + min(n, len(self))])
+
+    def pending(self):
+        return self.peek(len(self))
+
+    def next_frame(self):
+        """
+        Returns the raw bytes of the next complete frame or None.
+        """
+        frame_len = self.frame_len()
+        if frame_len is None or len(self) < frame_len:
+            return None
+
+        frame = bytes(memoryview(self._buf)[self._start:self._start + frame_len])
+        self._start += frame_len
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frame
+
+    def next_packet(self):
+        """
+        Returns the next complete Data- or ControlPacket or None.
+        """
+        if self.lazy:
+            frame_len = self.frame_len()
+            if frame_len is not None and len(self) >= frame_len and \
+                    Packet.packet_type(self.peek(1)) == DataPacket:
+                return LazyDataPacket(self._detach(frame_len))
+
+        frame = self.next_frame()
+        if frame is None:
+            return None
+        return Packet.packet_type(frame).parse(frame)
+
+    def _detach(self, frame_len):
+        # Give the current buffer away and continue with a fresh one
+        frame = memoryview(self._buf)[self._start:self._start + frame_len]
+        tail = memoryview(self._buf)[self._start + frame_len:self._end]
+        self._buf = bytearray(max(self._size, len(tail)))
+        self._buf[:len(tail)] = tail
+        self._start = 0
+        self._end = len(tail)
+        return frame
+
 
 class NTPShort:
     def __init__(self, seconds: int, fraction: int):
@@ -250,6 +599,24 @@ class NTPTimestamp:
         fracs = int((ts - int(ts)) * 2 ** 32)
         return cls(secs, fracs)
 
+    def to_fixed(self):
+        # 32.32 fixed point as on the wire
+        return (self.seconds << 32) | self.fraction
+
+    @classmethod
+    def from_fixed(cls, value):
+        return cls(value >> 32, value & 0xFFFFFFFF)
+
+    @classmethod
+    def fixed_from_ns(cls, ns):
+        """
+        Converts Unix time in nanoseconds (time.time_ns()) to 32.32 fixed
+        point without going through a float.
+        """
+        secs, ns = divmod(ns, 1_000_000_000)
+        # Seconds wrap around at the end of NTP era 0 (2036)
+        return (((secs + cls.UNIX_EPOCH_OFFSET) & 0xFFFFFFFF) << 32) | ((ns << 32) // 1_000_000_000)
+
     def __repr__(self):
         return f'NTPTimestamp {self.to_timestamp()}'
 
@@ -267,6 +634,14 @@ class NTPPacket(Packet):
     MODE_CLIENT = 3
     MODE_SERVER = 4
 
+    # NTPShort and NTPTimestamp fields as 16.16 and 32.32 fixed point integers
+    RECORD = struct.Struct('>BBbbII4sQQQQ')
+
+    # bytes.translate tables extracting li, version and mode from the flag byte
+    _FIELD_TABLES = [bytes((b >> 6) & 0b11 for b in range(256)),
+                     bytes((b >> 3) & 0b111 for b in range(256)),
+                     bytes(b & 0b111 for b in range(256))]
+
     def __init__(self, li: int, version: int, mode: int, stratum: int, poll: int, precision: int,
                  root_delay: NTPShort, root_dispersion: NTPShort,
                  reference_id: bytes,
@@ -359,3 +734,38 @@ class NTPPacket(Packet):
 
         return cls(li, version, mode, stratum, poll, precision, root_delay, root_dispersion, reference_id,
                    reference_ts, origin_ts, recv_ts, transmit_ts)
+
+    @classmethod
+    def serialize_many(cls, li, version, mode, stratum, poll, precision, root_delay, root_dispersion,
+                       reference_id, reference_ts, origin_ts, recv_ts, transmit_ts):
+        """
+        Encodes NTPColumns into one buffer of 48 byte records. Short and
+        timestamp columns are 16.16 and 32.32 fixed point integers.
+        """
+        flags = [(l & 0b11) << 6 | (v & 0b111) << 3 | (m & 0b111) for l, v, m in zip(li, version, mode)]
+        return b''.join(map(cls.RECORD.pack, flags, stratum, poll, precision, root_delay, root_dispersion,
+                            reference_id, reference_ts, origin_ts, recv_ts, transmit_ts))
+
+    @classmethod
+    def parse_many(cls, buffer):
+        """
+        Decodes a buffer of back to back NTP packets into NTPColumns.
+        """
+        if len(buffer) % cls.RECORD.size != 0:
+            raise ValueError('Buffer is not a multiple of the NTP packet size!')
+        if len(buffer) == 0:
+            return NTPColumns(*(array.array('B') for _ in range(4)), array.array('b'), array.array('b'),
+                              array.array('I'), array.array('I'), [],
+                              *(array.array('Q') for _ in range(4)))
+
+        (flags, stratum, poll, precision, root_delay, root_dispersion, reference_id,
+         reference_ts, origin_ts, recv_ts, transmit_ts) = zip(*cls.RECORD.iter_unpack(buffer))
+
+        flags = bytes(flags)
+        return NTPColumns(array.array('B', flags.translate(cls._FIELD_TABLES[0])),
+                          array.array('B', flags.translate(cls._FIELD_TABLES[1])),
+                          array.array('B', flags.translate(cls._FIELD_TABLES[2])),
+                          array.array('B', stratum), array.array('b', poll), array.array('b', precision),
+                          array.array('I', root_delay), array.array('I', root_dispersion), list(reference_id),
+                          array.array('Q', reference_ts), array.array('Q', origin_ts),
+                          array.array('Q', recv_ts), array.array('Q', transmit_ts))
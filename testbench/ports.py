@@ -0,0 +1,100 @@
+import os
+import fcntl
+import random
+import socket
+import tempfile
+import logging
+
+try:
+    from .fixtures import cleanup
+    from . import probes
+except (ImportError, ModuleNotFoundError):
+    from fixtures import cleanup
+    import probes
+
+log = logging.getLogger(__name__)
+
+# Shared between all runner processes on this host
+PORT_REGISTRY = os.path.join(tempfile.gettempdir(), "testbench-ports")
+
+# Stay below the default ephemeral range (32768-60999 on Linux), otherwise
+# outgoing connections may grab a leased port before the binary binds it
+PORT_RANGE = (20000, 32000)
+
+
+class PortLease(int):
+    """
+    A TCP/UDP port number that is reserved for the lifetime of the lease.
+    Being an int, it can be passed anywhere a port is expected
+    (MockServer addresses, MockClient, command line arguments).
+
+    The reservation is an exclusive flock on a file in PORT_REGISTRY, so it
+    is visible to every runner process and dies together with its holder.
+    """
+
+    def __new__(cls, port, fd):
+        lease = super().__new__(cls, port)
+        lease.fd = fd
+        return lease
+
+    @classmethod
+    def acquire(cls, attempts=1000):
+        os.makedirs(PORT_REGISTRY, exist_ok=True)
+
+        lo, hi = PORT_RANGE
+        for _ in range(attempts):
+            port = random.randrange(lo, hi)
+            fd = os.open(os.path.join(PORT_REGISTRY, str(port)), os.O_CREAT | os.O_RDWR, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+
+            if port_is_free(port):
+                log.debug(f"Leased port {port}")
+                return cls(port, fd)
+
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+        raise RuntimeError(f"Unable to lease a free port in range {lo}-{hi}")
+
+    def release(self):
+        if self.fd is None:
+            return
+        log.debug(f"Releasing port {int(self)}")
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+def port_is_free(port, host=""):
+    # No SO_REUSEADDR: ports with connections in TIME_WAIT count as taken
+    for kind in (socket.SOCK_STREAM, socket.SOCK_DGRAM):
+        sock = socket.socket(type=kind)
+        try:
+            sock.bind((host, port))
+        except OSError:
+            return False
+        finally:
+            sock.close()
+    return True
+
+
+@cleanup
+def lease_port(**kwargs):
+    """
+    Leases a free port that is unique across all concurrently running tests.
+    The lease is released in the cleanup phase of the current test.
+
+    Examples
+    ----------
+    > port = lease_port()
+    > server = MockServer(("127.0.0.1", port), DataPktHandler)
+    > exec_async([binary, "127.0.0.1", "{port}"], ports={"port": port})
+    """
+    lease = PortLease.acquire()
+    probes.track_port(lease)
+    yield lease
+    lease.release()
@@ -0,0 +1,119 @@
+import socket
+import threading
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# TCP state code in /proc/net/tcp
+TCP_TIME_WAIT = "06"
+
+# (port, udp) bound by mocks and leases during the current test
+USED_PORTS = set()
+_used_ports_lock = threading.Lock()
+
+
+def track_port(port, udp=False):
+    with _used_ports_lock:
+        USED_PORTS.add((int(port), udp))
+
+
+def take_used_ports():
+    with _used_ports_lock:
+        ports = set(USED_PORTS)
+        USED_PORTS.clear()
+    return ports
+
+
+def _poll(check, timeout, max_delay=0.05):
+    """
+    Calls check() with exponential backoff until it returns True or the
+    deadline passes. Returns the last result.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        if check():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+def _can_bind(port, udp=False, host="", reuse_addr=False):
+    sock = socket.socket(type=socket.SOCK_DGRAM if udp else socket.SOCK_STREAM)
+    try:
+        if reuse_addr:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def wait_for_port(host, port, timeout=5.0, udp=False):
+    """
+    Blocks until a TCP port accepts connections. For UDP, which has no
+    handshake, until some socket is bound to the port. Returns False if the
+    deadline passed first.
+
+    Meant for binaries started with exec_async. A mock server would see the
+    probe connection as an empty request.
+    """
+    def accepts():
+        if udp:
+            return not _can_bind(port, udp=True, host=host)
+        try:
+            socket.create_connection((host, port), timeout=timeout).close()
+            return True
+        except OSError:
+            return False
+
+    return _poll(accepts, timeout)
+
+
+def time_wait_ports():
+    """
+    Returns the local ports of all TCP connections in TIME_WAIT, or None if
+    /proc/net/tcp is not available.
+    """
+    ports = set()
+    found = False
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        found = True
+        for line in lines:
+            fields = line.split()
+            if fields[3] == TCP_TIME_WAIT:
+                ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+    return ports if found else None
+
+
+def wait_for_time_wait(port, timeout=60.0):
+    """
+    Blocks until no connection on a previously used local port is left in
+    TIME_WAIT, so the port can be bound without SO_REUSEADDR again.
+    """
+    def left_time_wait():
+        ports = time_wait_ports()
+        if ports is None:
+            return _can_bind(port)
+        return port not in ports
+
+    return _poll(left_time_wait, timeout, max_delay=0.25)
+
+
+def wait_port_free(port, timeout=1.0, udp=False):
+    """
+    Blocks until nothing listens on or is bound to the port anymore.
+    Connections in TIME_WAIT are ignored.
+    """
+    return _poll(lambda: _can_bind(port, udp=udp, reuse_addr=not udp), timeout)
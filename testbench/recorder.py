@@ -0,0 +1,281 @@
+import struct
+import socket
+import select
+import threading
+import logging
+import time
+
+try:
+    from .fixtures import cleanup
+    from .packet import PacketReader
+except (ImportError, ModuleNotFoundError):
+    from fixtures import cleanup
+    from packet import PacketReader
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'TBREC\x00\x01\x00'
+
+RECEIVED = 0
+SENT = 1
+
+TCP = 6
+UDP = 17
+
+# timestamp, direction, proto, src ip, src port, dst ip, dst port, length
+RECORD = struct.Struct('>dBB4sH4sHI')
+
+# Recorder all mocks write to, None if recording is off
+RECORDER = None
+
+
+def _ip_bytes(host):
+    try:
+        return socket.inet_aton(host)
+    except (OSError, TypeError):
+        return bytes(4)
+
+
+class Record:
+    __slots__ = ('timestamp', 'direction', 'proto', 'src', 'dst', 'data')
+
+    def __init__(self, timestamp, direction, proto, src, dst, data):
+        self.timestamp = timestamp
+        self.direction = direction
+        self.proto = proto
+        self.src = src
+        self.dst = dst
+        self.data = data
+
+    def __repr__(self):
+        direction = "sent" if self.direction == SENT else "received"
+        proto = "tcp" if self.proto == TCP else "udp"
+        return f"<Record {self.timestamp:.6f} {proto} {direction} {self.src} -> {self.dst} {len(self.data)} bytes>"
+
+
+class Recorder:
+    """
+    Appends packets as fixed size RECORD headers followed by the raw bytes
+    to a binary log. Addresses are IPv4 (host, port) tuples, direction is
+    seen from the mock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def record(self, direction, proto, src, dst, data):
+        header = RECORD.pack(time.time(), direction, proto,
+                             _ip_bytes(src[0]), src[1], _ip_bytes(dst[0]), dst[1], len(data))
+        with self.lock:
+            self.file.write(header)
+            self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def start_recording(path):
+    global RECORDER
+    stop_recording()
+    RECORDER = Recorder(path)
+    return RECORDER
+
+
+def stop_recording():
+    global RECORDER
+    if RECORDER is not None:
+        RECORDER.close()
+        RECORDER = None
+
+
+def record(direction, proto, src, dst, data):
+    # Called by the mocks for every packet, a no-op unless recording
+    recorder = RECORDER
+    if recorder is not None:
+        recorder.record(direction, proto, src, dst, data)
+
+
+def record_socket(direction, sock, data, peer=None):
+    """
+    Records data (bytes or a Packet, only serialized when recording) sent or
+    received on sock. peer is needed for unconnected UDP sockets.
+    """
+    recorder = RECORDER
+    if recorder is None:
+        return
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data = data.serialize()
+
+    local = sock.getsockname()
+    if peer is None:
+        try:
+            peer = sock.getpeername()
+        except OSError:
+            # Peer already reset the connection
+            peer = ("0.0.0.0", 0)
+    proto = TCP if sock.type == socket.SOCK_STREAM else UDP
+    src, dst = (local, peer) if direction == SENT else (peer, local)
+    recorder.record(direction, proto, src, dst, data)
+
+
+@cleanup
+def record_traffic(path, **kwargs):
+    """
+    Records all mock traffic of the current test to path until its cleanup.
+
+    Examples
+    ----------
+    > record_traffic(f"{build_dir}/{name}.tbrec")
+    """
+    recorder = start_recording(path)
+    yield recorder
+    stop_recording()
+
+
+def read_records(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a testbench recording')
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            ts, direction, proto, src_ip, src_port, dst_ip, dst_port, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # Truncated by a crash while writing
+                return
+            yield Record(ts, direction, proto, (socket.inet_ntoa(src_ip), src_port),
+                         (socket.inet_ntoa(dst_ip), dst_port), data)
+
+
+def _checksum(header):
+    s = sum(struct.unpack(f'>{len(header) // 2}H', header))
+    while s >> 16:
+        s = (s & 0xffff) + (s >> 16)
+    return ~s & 0xffff
+
+
+# Largest TCP payload fitting an IPv4 packet with 20 byte IP and TCP headers
+MAX_SEGMENT = 65535 - 40
+PCAP_SNAPLEN = 262144
+
+
+def export_pcap(path, out):
+    """
+    Writes a recording as pcap (LINKTYPE_RAW) with synthesized IPv4 and
+    TCP/UDP headers, so Wireshark can show and reassemble the streams.
+    TCP records larger than an IPv4 packet are split into several segments.
+    """
+    # Next sequence number per TCP flow
+    seqs = {}
+    ip_id = 0
+    with open(out, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, PCAP_SNAPLEN, 101))
+        for r in read_records(path):
+            if r.proto == TCP:
+                flow = (r.src, r.dst)
+                segments = []
+                for start in range(0, max(len(r.data), 1), MAX_SEGMENT):
+                    segment = r.data[start:start + MAX_SEGMENT]
+                    seq = seqs.get(flow, 0)
+                    seqs[flow] = (seq + len(segment)) & 0xffffffff
+                    # PSH | ACK
+                    l4 = struct.pack('>HHIIBBHHH', r.src[1], r.dst[1], seq, 0, 5 << 4, 0x18, 65535, 0, 0)
+                    segments.append((l4, segment))
+            else:
+                segments = [(struct.pack('>HHHH', r.src[1], r.dst[1], 8 + len(r.data), 0), r.data)]
+
+            sec = int(r.timestamp)
+            usec = int((r.timestamp - sec) * 1e6)
+            for l4, payload in segments:
+                ip = bytearray(struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(l4) + len(payload), ip_id,
+                                           0x4000, 64, r.proto, 0,
+                                           socket.inet_aton(r.src[0]), socket.inet_aton(r.dst[0])))
+                struct.pack_into('>H', ip, 10, _checksum(ip))
+                ip_id = (ip_id + 1) & 0xffff
+
+                frame = bytes(ip) + l4 + payload
+                f.write(struct.pack('<IIII', sec, usec, len(frame), len(frame)))
+                f.write(frame)
+
+
+class ReplayStats:
+    def __init__(self, sent, responses, errors, elapsed):
+        self.sent = sent
+        self.responses = responses
+        self.errors = errors
+        self.elapsed = elapsed
+
+    @property
+    def rate(self):
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (f"{self.sent} packets in {self.elapsed:.3f}s ({self.rate:.0f}/s), "
+                f"{self.responses} responses, {self.errors} errors")
+
+
+class Replayer:
+    """
+    Re-sends the packets the mocks sent in a recording to a binary at
+    (host, port). With dst_port only packets originally sent to that port
+    are replayed. speed scales the original timing, None sends as fast as
+    possible. TCP packets are sent on a connection each, like the mocks do;
+    with await_response the replayer reads one response packet per request.
+    """
+
+    def __init__(self, path, dst_port=None):
+        self.records = [r for r in read_records(path)
+                        if r.direction == SENT and (dst_port is None or r.dst[1] == dst_port)]
+
+    def _send_tcp(self, host, port, data, await_response, timeout):
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(data)
+            if not await_response:
+                return False
+
+            reader = PacketReader()
+            while reader.next_frame() is None:
+                readable, _, _ = select.select([sock], [], [], timeout)
+                if sock not in readable or reader.read_from(sock) == 0:
+                    raise TimeoutError(f'No response from {host}:{port}')
+            return True
+
+    def replay(self, host, port, speed=1.0, await_response=False, timeout=3.0):
+        udp = socket.socket(type=socket.SOCK_DGRAM)
+        udp.settimeout(timeout)
+        sent = responses = errors = 0
+
+        start = time.monotonic()
+        first = self.records[0].timestamp if self.records else 0.0
+        try:
+            for r in self.records:
+                if speed is not None:
+                    delay = start + (r.timestamp - first) / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                try:
+                    if r.proto == TCP:
+                        responses += self._send_tcp(host, port, r.data, await_response, timeout)
+                    else:
+                        udp.sendto(r.data, (host, port))
+                        if await_response:
+                            udp.recv(65535)
+                            responses += 1
+                    sent += 1
+                except OSError as ex:
+                    log.debug(f"Replay of {r} failed: {ex}")
+                    errors += 1
+        finally:
+            udp.close()
+
+        stats = ReplayStats(sent, responses, errors, time.monotonic() - start)
+        log.info(f"Replayed {stats}")
+        return stats
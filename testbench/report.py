@@ -0,0 +1,113 @@
+import json
+import traceback
+import xml.etree.ElementTree as ET
+
+
+class TestResult:
+    """
+    Outcome and timings (seconds, monotonic clock) of a single test function.
+    Only holds plain data so it can be sent back from parallel workers.
+    """
+
+    def __init__(self, name, module, error=None, duration=0.0, cleanup=None, resources=None):
+        self.name = name
+        self.module = module
+        self.succeeded = error is None
+        self.error = None
+        if error is not None:
+            self.error = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+        self.duration = duration
+        # [(cleanup function name, seconds)]
+        self.cleanup = cleanup if cleanup is not None else []
+        # [(command, ResourceMonitor.summary())]
+        self.resources = resources if resources is not None else []
+        # Wait after the test before the next one started
+        self.wait = 0.0
+        # Replayed from the result cache instead of executed
+        self.cached = False
+
+    @classmethod
+    def from_dict(cls, d):
+        result = cls(d["name"], d["module"], None, d["duration"],
+                     [(c["name"], c["duration"]) for c in d["cleanup"]],
+                     [(r.pop("command"), r) for r in map(dict, d["resources"])])
+        result.succeeded = d["status"] == "passed"
+        result.error = d["error"]
+        result.wait = d["wait"]
+        result.cached = d.get("cached", False)
+        return result
+
+    @property
+    def cleanup_duration(self):
+        return sum(t for _, t in self.cleanup)
+
+    @property
+    def total_duration(self):
+        return self.duration + self.cleanup_duration + self.wait
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "module": self.module,
+            "status": "passed" if self.succeeded else "failed",
+            "duration": self.duration,
+            "cleanup": [{"name": name, "duration": t} for name, t in self.cleanup],
+            "cleanup_duration": self.cleanup_duration,
+            "wait": self.wait,
+            "total_duration": self.total_duration,
+            "resources": [dict(summary, command=cmd) for cmd, summary in self.resources],
+            "error": self.error,
+            "cached": self.cached,
+        }
+
+
+def write_jsonl(path, results):
+    with open(path, "w") as f:
+        for result in results:
+            f.write(json.dumps(result.as_dict()) + "\n")
+
+
+def write_junit(path, results):
+    failures = sum(1 for r in results if not r.succeeded)
+    suites = ET.Element("testsuites")
+    suite = ET.SubElement(suites, "testsuite", name="testbench", tests=str(len(results)),
+                          failures=str(failures), errors="0",
+                          time=f"{sum(r.total_duration for r in results):.6f}")
+
+    for result in results:
+        case = ET.SubElement(suite, "testcase", classname=result.module, name=result.name,
+                             time=f"{result.duration + result.cleanup_duration:.6f}")
+        if not result.succeeded:
+            message = result.error.strip().splitlines()[-1] if result.error else "failed"
+            failure = ET.SubElement(case, "failure", message=message)
+            failure.text = result.error
+
+        lines = [f"cleanup {name}: {t:.3f}s" for name, t in result.cleanup]
+        lines += [f"resources {cmd}: {json.dumps(summary)}" for cmd, summary in result.resources]
+        if lines:
+            ET.SubElement(case, "system-out").text = "\n".join(lines)
+
+    ET.ElementTree(suites).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def write_report(path, results):
+    """
+    Writes JUnit XML for *.xml paths and JSON lines otherwise.
+    """
+    if path.endswith(".xml"):
+        write_junit(path, results)
+    else:
+        write_jsonl(path, results)
+
+
+def slowest(results, n):
+    """
+    Lines describing the n slowest results. Cached results are left out,
+    their durations are from an earlier run.
+    """
+    lines = []
+    executed = [r for r in results if not r.cached]
+    for r in sorted(executed, key=lambda r: r.total_duration, reverse=True)[:n]:
+        lines.append(f"{r.total_duration:8.3f}s  {r.name} (test {r.duration:.3f}s, "
+                     f"cleanup {r.cleanup_duration:.3f}s, wait {r.wait:.3f}s)")
+    return lines
@@ -0,0 +1,448 @@
+import contextlib
+import ctypes
+import ctypes.util
+import socketserver
+import threading
+import argparse
+import inspect
+import pathlib
+import struct
+import select
+import socket
+import json
+import time
+import sys
+import os
+import logging
+
+try:
+    from . import testrunner
+    from . import custom_logging
+except (ImportError, ModuleNotFoundError):
+    import testrunner
+    import custom_logging
+
+log = logging.getLogger(__name__)
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_ISDIR = 0x40000000
+# wd, mask, cookie, name length
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(runtime_dir, f'testbench-{os.getuid()}.sock')
+
+
+class InotifyWatcher:
+    """
+    Reports files written, moved or chmod-ed anywhere below root, using
+    inotify through ctypes. New subdirectories are watched as they appear.
+    """
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, root):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.dirs = {}
+        for path, _, _ in os.walk(root):
+            self._add(path)
+
+    def _add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd >= 0:
+            self.dirs[wd] = path
+
+    def changes(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        changed = set()
+        if not readable:
+            return changed
+
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                start = offset + INOTIFY_EVENT.size
+                name = os.fsdecode(data[start:start + length].rstrip(b'\0'))
+                offset = start + length
+                if wd not in self.dirs:
+                    continue
+
+                path = os.path.join(self.dirs[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._add(path)
+                else:
+                    changed.add(path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Fallback for InotifyWatcher comparing mtime and size of all files below
+    root every call.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.files = self._scan()
+
+    def _scan(self):
+        files = {}
+        for path, _, names in os.walk(self.root):
+            for name in names:
+                full = os.path.join(path, name)
+                try:
+                    st = os.stat(full)
+                except OSError:
+                    continue
+                files[full] = (st.st_mtime_ns, st.st_size, st.st_mode)
+        return files
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        files = self._scan()
+        changed = {path for path, state in files.items() if self.files.get(path) != state}
+        self.files = files
+        return changed
+
+    def close(self):
+        pass
+
+
+def watch_directory(root):
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError) as ex:
+        log.info(f"inotify not available ({ex}), polling {root}")
+        return PollingWatcher(root)
+
+
+class _Output:
+    """
+    File like object forwarding everything written to the client as JSON
+    lines. Once the client is gone output is dropped.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, message):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.wfile.write(json.dumps(message).encode() + b'\n')
+                self.wfile.flush()
+            except OSError:
+                self.closed = True
+
+    def write(self, text):
+        if text:
+            self.send({"output": text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+@contextlib.contextmanager
+def _redirect(stream, cwd):
+    # Output of logging, print() and the runner goes to stream
+    handlers = [h for h in logging.getLogger().handlers
+                if isinstance(h, logging.StreamHandler) and not isinstance(h, logging.FileHandler)]
+    streams = [h.stream for h in handlers]
+    old_cwd = os.getcwd()
+    for h in handlers:
+        h.setStream(stream)
+    os.chdir(cwd)
+    try:
+        with contextlib.redirect_stdout(stream), contextlib.redirect_stderr(stream):
+            yield
+    finally:
+        os.chdir(old_cwd)
+        for h, s in zip(handlers, streams):
+            h.setStream(s)
+
+
+class RunRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one JSON request line and answers with {"output": text} lines
+    followed by {"exit": code}. Requests are {"args": [...], "cwd": path}
+    with the arguments of a normal testbench run, or {"command": "stop"}.
+    """
+
+    def handle(self):
+        out = _Output(self.wfile)
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            out.send({"output": "Invalid request\n", "exit": 2})
+            return
+
+        if request.get("command") == "stop":
+            # shutdown() waits for serve_forever, which runs this handler
+            threading.Thread(target=self.server.shutdown).start()
+            out.send({"exit": 0})
+            return
+
+        code = self.server.run(request.get("args", []), request.get("cwd", os.getcwd()), out)
+        out.send({"exit": code})
+
+
+class TestDaemon(socketserver.UnixStreamServer):
+    """
+    Keeps the interpreter and imported test modules warm between runs. A
+    test module is only executed again when its source changed since it was
+    imported; helper modules it imports are not reloaded. Runs are
+    serialized, their output goes to the requesting client. Test files are
+    imported under their file name, so of two files with the same name only
+    the one requested last is loaded.
+
+    -j is rejected: forking worker processes from the daemon, which runs
+    the socket and watcher threads, is not safe.
+
+    With watch_dir set, changed files below it (e.g. rebuilt binaries)
+    rerun the tests of the last request whose source mentions the file
+    name, or all of them if none does.
+
+    Examples
+    ----------
+    > testbench serve -bd build --watch &
+    > testbench remote -t tests/chord.py -tf test_join
+    """
+
+    def __init__(self, socket_path, watch_dir=None):
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(socket_path)
+                raise RuntimeError(f'A daemon is already listening on {socket_path}')
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left over from a daemon that did not exit cleanly
+                os.unlink(socket_path)
+            finally:
+                probe.close()
+
+        super().__init__(socket_path, RunRequestHandler)
+        self.lock = threading.RLock()
+        # real path -> mtime when it was imported
+        self.modules = {}
+        # (args, cwd) of the last run request, rerun by the watcher
+        self.last_request = None
+        self.stopped = threading.Event()
+        # Console of the daemon for watch reruns; sys.stdout is redirected
+        # to the client while a remote run is in progress
+        self.console = sys.stdout
+        self.watch_thread = None
+        if watch_dir is not None:
+            self.watch_thread = threading.Thread(target=self.watch, args=(watch_dir,), daemon=True)
+            self.watch_thread.start()
+
+    def server_close(self):
+        super().server_close()
+        self.stopped.set()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.server_address)
+
+    def load(self, test_path):
+        """
+        Imports a test module, or executes it again if its source changed.
+        Returns the module name.
+        """
+        path = os.path.realpath(test_path)
+        name = pathlib.Path(path).stem
+        mtime = os.stat(path).st_mtime_ns
+        module = sys.modules.get(name)
+        current = module is not None and self.modules.get(path) is not None
+        if current and self.modules[path] == mtime:
+            return name
+
+        if module is not None and not current:
+            # Another file of the same name, reload() would execute that one
+            log.info(f"Replacing test module {name} from {getattr(module, '__file__', None)}")
+            del sys.modules[name]
+            testrunner.TEST_ARRAY[:] = [t for t in testrunner.TEST_ARRAY if t.module != name]
+            self.modules = {p: m for p, m in self.modules.items() if pathlib.Path(p).stem != name}
+
+        testrunner.import_test_module(path, reload=current)
+        self.modules[path] = mtime
+        return name
+
+    def run(self, argv, cwd, out, only=None):
+        with self.lock, _redirect(out, cwd):
+            try:
+                return self._run(argv, cwd, only)
+            except SystemExit as ex:
+                return ex.code if isinstance(ex.code, int) else 1
+            except Exception:
+                log.exception("Run request failed")
+                return 1
+
+    def _run(self, argv, cwd, only):
+        args = testrunner.build_parser('testbench remote').parse_args(argv)
+        logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.INFO)
+        if args.jobs > 1:
+            log.error("-j is not supported by testbench remote, the daemon cannot fork workers safely")
+            return 1
+
+        build_dir = os.path.join(cwd, args.build_dir)
+        if os.path.isdir(build_dir) is False:
+            log.error(f"Build directory does not exist: {build_dir}")
+            return 1
+
+        whitelist = set(args.test_func or [])
+        if only is not None:
+            whitelist = only
+        test_paths = [os.path.join(cwd, p) for p in args.test]
+        if whitelist and not args.no_discovery:
+            test_paths = testrunner.select_modules(test_paths, whitelist)
+
+        modules = {self.load(p) for p in test_paths}
+        selected = testrunner.select_tests(whitelist, modules)
+        if len(selected) == 0:
+            log.error("No tests have been found!")
+            return 1
+        if only is None:
+            self.last_request = (argv, cwd)
+
+        results = testrunner.run_tests(selected, build_dir, args.jobs, testrunner.open_result_cache(args))
+        args.report = [os.path.join(cwd, p) for p in args.report]
+        testrunner.finish(results, args)
+        return 0 if all(r.succeeded for r in results) else 1
+
+    def affected_tests(self, changed):
+        """
+        Names of the tests of the last request whose source mentions the
+        name of a changed file.
+        """
+        argv, _ = self.last_request
+        args = testrunner.build_parser().parse_args(argv)
+        whitelist = set(args.test_func or [])
+        modules = {pathlib.Path(p).stem for p in args.test}
+        names = {os.path.basename(p) for p in changed}
+
+        affected = set()
+        for i in testrunner.select_tests(whitelist, modules):
+            test = testrunner.TEST_ARRAY[i]
+            try:
+                source = inspect.getsource(test.wrapper)
+            except (OSError, TypeError):
+                continue
+            if any(name in source for name in names):
+                affected.add(test.func_name)
+        return affected
+
+    def watch(self, root):
+        watcher = watch_directory(root)
+        try:
+            while not self.stopped.is_set():
+                changed = watcher.changes(1.0)
+                if not changed:
+                    continue
+                # A build writes several files, wait until it is done
+                while more := watcher.changes(0.5):
+                    changed |= more
+
+                if self.last_request is None:
+                    log.info(f"{len(changed)} files changed, no tests requested yet")
+                    continue
+                # Held throughout so no remote run redirects the log in between
+                with self.lock:
+                    affected = self.affected_tests(changed)
+                    log.info(f"{len(changed)} files changed, rerunning "
+                             f"{', '.join(sorted(affected)) if affected else 'all tests of the last request'}")
+                    argv, cwd = self.last_request
+                    self.run(argv, cwd, self.console, affected or None)
+        finally:
+            watcher.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                    prog = 'testbench serve',
+                    description = 'Keeps tests loaded and runs them for testbench remote')
+
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--socket", action="store", default=default_socket_path())
+    parser.add_argument("-bd", "--build_dir", action="store", default="build",
+                        help="Directory watched with --watch")
+    parser.add_argument("--watch", action="store_true",
+                        help="Rerun the last requested tests when files in the build directory change")
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        custom_logging.register(logging.DEBUG)
+    else:
+        custom_logging.register(logging.INFO)
+
+    watch_dir = None
+    if args.watch:
+        watch_dir = os.path.join(os.getcwd(), args.build_dir)
+        if os.path.isdir(watch_dir) is False:
+            log.error(f"Build directory does not exist: {watch_dir}")
+            exit(1)
+
+    daemon = TestDaemon(args.socket, watch_dir)
+    log.info(f"Listening on {args.socket}")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+
+def remote(argv=None):
+    """
+    Client of testbench serve. Takes the arguments of a normal run and
+    exits with 1 if a test failed.
+    """
+    parser = argparse.ArgumentParser(
+                    prog = 'testbench remote',
+                    description = 'Runs tests in a testbench serve daemon, other arguments as for testbench',
+                    add_help=False)
+    parser.add_argument("--socket", action="store", default=default_socket_path())
+    parser.add_argument("--stop", action="store_true", help="Stop the daemon")
+    args, rest = parser.parse_known_args(argv)
+
+    if args.stop:
+        request = {"command": "stop"}
+    else:
+        request = {"args": rest, "cwd": os.getcwd()}
+
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(args.socket)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"No testbench serve daemon listening on {args.socket}", file=sys.stderr)
+        exit(2)
+
+    code = 1
+    with sock, sock.makefile('rb') as f:
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        for line in f:
+            message = json.loads(line)
+            if "output" in message:
+                sys.stdout.write(message["output"])
+                sys.stdout.flush()
+            if "exit" in message:
+                code = message["exit"]
+    exit(code)
@@ -0,0 +1,241 @@
+import heapq
+import itertools
+import threading
+import random
+import queue
+import sys
+import logging
+
+try:
+    from .packet import Packet, PacketReader
+    from .mock import PacketInbox, MockServer, GeneralPktHandler
+except (ImportError, ModuleNotFoundError):
+    from packet import Packet, PacketReader
+    from mock import PacketInbox, MockServer, GeneralPktHandler
+
+log = logging.getLogger(__name__)
+
+
+class SimEndpoint:
+    """
+    Mock peer attached to a SimNetwork. Has the same interface as the
+    endpoints of a SocketNetwork (queue, resp_q, send_response, ip,
+    server_address, await_packet, send) but never touches a socket.
+
+    Received packets go into self.queue. If handler is set it is called as
+    handler(endpoint, packet, src_address) for every packet, e.g. to let the
+    peer forward LOOKUPs along the ring. With send_response set the next
+    item of resp_q is sent back like GeneralPktHandler does; resp_q has to be
+    filled beforehand since nothing runs concurrently.
+    """
+
+    def __init__(self, network, address, handler=None):
+        self.network = network
+        self.server_address = address
+        self.ip = address[0]
+        self.handler = handler
+        self.queue = PacketInbox()
+        self.resp_q = queue.Queue()
+        self.send_response = False
+
+    def send(self, packet, address):
+        self.network.send(self.server_address, address, packet)
+
+    def deliver(self, packet, src):
+        self.queue.put(packet)
+        if self.handler is not None:
+            self.handler(self, packet, src)
+
+        if self.send_response:
+            try:
+                response = self.resp_q.get_nowait()
+            except queue.Empty:
+                raise RuntimeError(
+                    'Expected response packet in queue! This should not happen!')
+            if isinstance(response, Packet):
+                self.send(response, src)
+            else:
+                p, host, port = response
+                self.send(p, (host, port))
+
+    def await_packet(self, packet_type, timeout, match=None):
+        """
+        Runs the simulation until a matching packet arrived or timeout
+        seconds of virtual time passed.
+        """
+        deadline = self.network.now + timeout
+        while True:
+            packet = self.queue.await_packet(packet_type, 0, match)
+            if packet is not None:
+                return packet
+            if not self.network.step(deadline):
+                self.network.now = max(self.network.now, deadline)
+                return None
+
+    def await_all(self, n, packet_type, timeout, match=None):
+        deadline = self.network.now + timeout
+        packets = []
+        while len(packets) < n:
+            packet = self.await_packet(packet_type, max(deadline - self.network.now, 0), match)
+            if packet is None:
+                break
+            packets.append(packet)
+        return packets
+
+    def drain(self, packet_type=None, match=None):
+        return self.queue.drain(packet_type, match)
+
+    def close(self):
+        self.network.endpoints.pop(self.server_address, None)
+
+
+class SimNetwork:
+    """
+    Discrete event network routing serialized packets between SimEndpoints
+    in memory. Time is virtual (seconds, starting at 0): every packet is
+    delivered latency + uniform(0, jitter) after it was sent, in order of
+    delivery time. With a seed the whole run is deterministic, so rings of
+    thousands of peers can be simulated in a single thread.
+
+    Examples
+    ----------
+    > net = SimNetwork(latency=0.001, jitter=0.0005, seed=1)
+    > peers = [net.endpoint() for _ in range(1000)]
+    > peers[0].send(ControlPacket('LOOKUP', 42, 0, ip, port), peers[1].server_address)
+    > peers[1].await_packet(ControlPacket, 1.0, match={'method': 'LOOKUP'})
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.endpoints = {}
+        # (delivery time, sequence number, src, dst, serialized packet)
+        self.events = []
+        self.seq = itertools.count()
+        self.ports = itertools.count(20000)
+        self.delivered = 0
+        self.dropped = 0
+
+    def endpoint(self, address=None, handler=None):
+        if address is None:
+            address = ("127.0.0.1", next(self.ports))
+        if address in self.endpoints:
+            raise ValueError(f'Address {address} already in use')
+        ep = SimEndpoint(self, address, handler)
+        self.endpoints[address] = ep
+        return ep
+
+    def send(self, src, dst, packet):
+        delay = self.latency
+        if self.jitter:
+            delay += self.rng.uniform(0, self.jitter)
+        data = bytes(packet.serialize())
+        heapq.heappush(self.events, (self.now + delay, next(self.seq), src, tuple(dst), data))
+
+    def step(self, until=None):
+        """
+        Delivers the next packet if it is due before until. Returns False if
+        there was none.
+        """
+        if not self.events or (until is not None and self.events[0][0] > until):
+            return False
+
+        t, _, src, dst, data = heapq.heappop(self.events)
+        self.now = max(self.now, t)
+        ep = self.endpoints.get(dst)
+        if ep is None:
+            log.debug(f"Dropping packet from {src} to unknown endpoint {dst}")
+            self.dropped += 1
+            return True
+
+        self.delivered += 1
+        try:
+            reader = PacketReader()
+            reader.feed(data)
+            packet = reader.next_packet()
+            if packet is None:
+                raise ValueError(f'Incomplete packet of {len(data)} bytes from {src}')
+            ep.deliver(packet, src)
+        except Exception:
+            ep.queue.put(sys.exc_info())
+        return True
+
+    def run(self, until=None):
+        """
+        Processes events until none are left or virtual time until is
+        reached. Returns the number of delivered packets.
+        """
+        n = 0
+        while self.step(until):
+            n += 1
+        if until is not None:
+            self.now = max(self.now, until)
+        return n
+
+    def close(self):
+        self.endpoints.clear()
+        self.events.clear()
+
+
+class PeerPktHandler(GeneralPktHandler):
+    """
+    Reads one packet of any type and passes it to the handler callback of a
+    SocketEndpoint before the optional response is sent. Unlike in the
+    simulation the source address is the ephemeral port of the connection.
+    """
+    def handle_request(self):
+        self.get_first_byte()
+        packet = self.read_packet("Peer did not send a full packet")
+        self.server.queue.put(packet)
+        if self.server.handler is not None:
+            self.server.handler(self.server, packet, self.client_address)
+
+        if self.server.send_response:
+            self.send_response()
+
+
+class SocketEndpoint(MockServer):
+    def __init__(self, network, address, handler=None):
+        super().__init__(address, PeerPktHandler)
+        self.network = network
+        self.handler = handler
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def send(self, packet, address):
+        host, port = address
+        GeneralPktHandler._connect_and_send(packet, host, port, self.persistent_connections)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+        self.network.endpoints.pop(self.server_address, None)
+
+
+class SocketNetwork:
+    """
+    Real TCP counterpart of SimNetwork. Every endpoint is a MockServer on
+    a leased port served by its own thread, time is wall clock time.
+    """
+
+    def __init__(self, host="127.0.0.1"):
+        self.host = host
+        self.endpoints = {}
+
+    def endpoint(self, address=None, handler=None):
+        if address is None:
+            address = (self.host, None)
+        ep = SocketEndpoint(self, address, handler)
+        self.endpoints[ep.server_address] = ep
+        return ep
+
+    def run(self, until=None):
+        # Packets are delivered by the server threads
+        return 0
+
+    def close(self):
+        for ep in list(self.endpoints.values()):
+            ep.close()
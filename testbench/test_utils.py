@@ -1,13 +1,170 @@
 import logging
 import threading
 import subprocess
+import selectors
+import collections
+import array
+import tempfile
+import re
 import sys
 import time
 import signal
 import os
 
+
+class OutputBuffer:
+    """
+    Ring buffer keeping the last `limit` bytes of a process output stream.
+    With spill=True the complete stream is additionally written to a
+    temporary file (self.path).
+    """
+
+    def __init__(self, limit=1 << 20, spill=False):
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+        self.total = 0
+        self.file = None
+        self.path = None
+        if spill:
+            self.file = tempfile.NamedTemporaryFile(prefix="testbench-", suffix=".log", delete=False)
+            self.path = self.file.name
+
+    @property
+    def dropped(self):
+        return self.total - self.size
+
+    def write(self, data):
+        if self.file is not None:
+            self.file.write(data)
+
+        self.chunks.append(data)
+        self.size += len(data)
+        self.total += len(data)
+
+        while self.size > self.limit:
+            excess = self.size - self.limit
+            head = self.chunks[0]
+            if len(head) <= excess:
+                self.chunks.popleft()
+                self.size -= len(head)
+            else:
+                self.chunks[0] = head[excess:]
+                self.size -= excess
+
+    def tail(self, since=0):
+        """
+        Returns the buffered bytes starting at absolute stream offset `since`.
+        """
+        data = b''.join(self.chunks)
+        return data[max(since - self.dropped, 0):]
+
+    def text(self):
+        text = self.tail().decode("utf-8", errors="replace")
+        if self.dropped > 0:
+            where = f", full output in {self.path}" if self.path else ""
+            text = f"[... {self.dropped} bytes truncated{where}]\n" + text
+        return text
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+# (command, ResourceMonitor) of finished processes, drained by the testrunner
+RESOURCE_USAGE = []
+_resource_lock = threading.Lock()
+
+
+def take_resource_usage():
+    global RESOURCE_USAGE
+    with _resource_lock:
+        usage, RESOURCE_USAGE = RESOURCE_USAGE, []
+    return usage
+
+
+class ResourceMonitor:
+    """
+    Samples CPU time, RSS, peak RSS, thread and open fd count of a process
+    from /proc/<pid>/stat and /proc/<pid>/status into a compact time series.
+    Memory is in bytes, CPU time in seconds.
+    """
+    CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.start = time.monotonic()
+
+        self.times = array.array('d')
+        self.cpu = array.array('d')
+        self.rss = array.array('Q')
+        self.threads = array.array('I')
+        self.fds = array.array('I')
+        self.peak_rss = 0
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                # comm may contain spaces, fields are counted after its ')'
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f"/proc/{self.pid}/status") as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+            fds = len(os.listdir(f"/proc/{self.pid}/fd"))
+        except (OSError, IndexError):
+            # Not on Linux or process already gone
+            return False
+
+        if 'VmRSS' not in status:
+            # Zombie
+            return False
+
+        self.times.append(time.monotonic() - self.start)
+        self.cpu.append((int(fields[11]) + int(fields[12])) / self.CLK_TCK)
+        self.threads.append(int(fields[17]))
+        self.rss.append(int(status['VmRSS'].split()[0]) * 1024)
+        self.peak_rss = max(self.peak_rss, int(status.get('VmHWM', status['VmRSS']).split()[0]) * 1024)
+        self.fds.append(fds)
+        return True
+
+    def summary(self):
+        if len(self.times) == 0:
+            return {}
+
+        wall = self.times[-1] if self.times[-1] > 0 else self.interval
+        return {
+            'samples': len(self.times),
+            'cpu_seconds': self.cpu[-1],
+            'avg_utilisation': self.cpu[-1] / wall,
+            'peak_rss': max(self.peak_rss, max(self.rss)),
+            'max_threads': max(self.threads),
+            'max_fds': max(self.fds),
+        }
+
+    def __str__(self):
+        s = self.summary()
+        if not s:
+            return "no resource samples"
+        return (f"peak RSS {s['peak_rss'] / (1 << 20):.1f} MiB, CPU {s['cpu_seconds']:.2f} s, "
+                f"avg utilisation {s['avg_utilisation'] * 100:.0f}%, max threads {s['max_threads']}, "
+                f"max fds {s['max_fds']} ({s['samples']} samples)")
+
+
+def _pidfd_open(pid):
+    # Becomes readable when the process exits (Linux 5.3+)
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
 class ExecAsyncHandler(threading.Thread):
-    def __init__(self, cmd, timeout):
+    # Without pidfd support process exit is polled at this interval
+    poll_interval = 0.05
+    # Time to drain pipes kept open by children after the process exited
+    drain_timeout = 0.5
+
+    def __init__(self, cmd, timeout, output_limit=1 << 20, spill=False, sample_interval=None):
         self.cmd = cmd
         # calling parent class constructor
         threading.Thread.__init__(self)
@@ -18,7 +175,17 @@ class ExecAsyncHandler(threading.Thread):
         self.timeout = timeout
         self.process = None
         self.stop_flag = False
-        self.timer = 0
+        self.sample_interval = sample_interval
+        self.resources = None
+
+        self.stdout_buf = OutputBuffer(output_limit, spill)
+        self.stderr_buf = OutputBuffer(output_limit, spill)
+        self.finished = False
+        self.output_cond = threading.Condition()
+
+        # Lets stop() interrupt the selector
+        self._wakeup_lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
 
     def run(self):
         self.log.debug(f"Executing: {self.cmd_str}")
@@ -29,41 +196,114 @@ class ExecAsyncHandler(threading.Thread):
             "ASAN_OPTIONS": "print_stacktrace=1:color=always:halt_on_error=1"
         }
 
-        self.process = subprocess.Popen(
-            self.cmd,
-            stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=proc_env,
-            encoding="utf-8"
-        )
-
-        while not self.stop_flag:
-            if self.timer >= self.timeout:
-                self.retcode = -1
-                self.process.kill()
-                self.process.wait(3)
-                self.stdout, self.stderr = self.process.communicate()
-
-                self.log.error(
-                    f"Timeout expired executing {self.cmd_str}")
-                return
-            try:
-                self.process.wait(0.1)
-                self.stdout, self.stderr = self.process.communicate()
-                self.retcode = self.process.returncode
-                self.log.debug(f"Process returned {self.retcode}")
-                return
-            except subprocess.TimeoutExpired as ex:
-                pass
-            self.timer += 0.1
-
-        # if stop flag has been set
-        self.log.debug(f"Killing process {self.cmd_str}")
-        self.process.kill()
-        self.process.wait(3)
-        self.stdout, self.stderr = self.process.communicate()
+        try:
+            self.process = subprocess.Popen(
+                self.cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=proc_env
+            )
+            if self.sample_interval is not None:
+                self.resources = ResourceMonitor(self.process.pid, self.sample_interval)
+            self._communicate()
+        finally:
+            with self._wakeup_lock:
+                os.close(self._wakeup_r)
+                os.close(self._wakeup_w)
+                self._wakeup_r = self._wakeup_w = None
+
+            self.stdout_buf.close()
+            self.stderr_buf.close()
+            self.stdout = self.stdout_buf.text()
+            self.stderr = self.stderr_buf.text()
+            with self.output_cond:
+                self.finished = True
+                self.output_cond.notify_all()
+
+            if self.resources is not None:
+                self.log.debug(f"{self.cmd_str}: {self.resources}")
+                with _resource_lock:
+                    RESOURCE_USAGE.append((self.cmd_str, self.resources))
+
+    def _communicate(self):
+        deadline = time.monotonic() + self.timeout
+        next_sample = time.monotonic()
+        timed_out = False
+        killed = False
+        exited = False
+
+        sel = selectors.DefaultSelector()
+        sel.register(self.process.stdout, selectors.EVENT_READ, self.stdout_buf)
+        sel.register(self.process.stderr, selectors.EVENT_READ, self.stderr_buf)
+        sel.register(self._wakeup_r, selectors.EVENT_READ, None)
+        pidfd = _pidfd_open(self.process.pid)
+        if pidfd is not None:
+            sel.register(pidfd, selectors.EVENT_READ, "exit")
+
+        try:
+            while True:
+                now = time.monotonic()
+                if not exited and self.process.poll() is not None:
+                    exited = True
+                    deadline = now + self.drain_timeout
+
+                streams = [k for k in sel.get_map().values() if isinstance(k.data, OutputBuffer)]
+                if exited and (not streams or now >= deadline):
+                    break
+                if killed and not exited and now >= deadline:
+                    break
+
+                if not exited and not killed:
+                    if now >= deadline:
+                        timed_out = True
+                    if timed_out or self.stop_flag:
+                        self.log.debug(f"Killing process {self.cmd_str}")
+                        self.process.kill()
+                        killed = True
+                        deadline = now + 3
+
+                if self.resources is not None and not exited:
+                    if now >= next_sample:
+                        self.resources.sample()
+                        next_sample = now + self.sample_interval
+                    wait = max(min(deadline, next_sample) - now, 0)
+                else:
+                    wait = max(deadline - now, 0)
+
+                if pidfd is None and not exited:
+                    wait = min(wait, self.poll_interval)
+
+                for key, _ in sel.select(wait):
+                    if key.data is None:
+                        os.read(self._wakeup_r, 512)
+                    elif key.data == "exit":
+                        sel.unregister(pidfd)
+                    else:
+                        data = os.read(key.fd, 65536)
+                        if not data:
+                            sel.unregister(key.fileobj)
+                            continue
+                        with self.output_cond:
+                            key.data.write(data)
+                            self.output_cond.notify_all()
+        finally:
+            sel.close()
+            if pidfd is not None:
+                os.close(pidfd)
+
+        if not exited:
+            self.process.kill()
+        self.process.wait()
         self.retcode = self.process.returncode
 
+        if timed_out:
+            self.retcode = -1
+            self.log.error(
+                f"Timeout expired executing {self.cmd_str}")
+        else:
+            self.log.debug(f"Process returned {self.retcode}")
+
     @property
     def sig_name(self):
         try:
@@ -78,6 +318,41 @@ class ExecAsyncHandler(threading.Thread):
 
     def stop(self):
         self.stop_flag = True
+        with self._wakeup_lock:
+            if self._wakeup_w is not None:
+                os.write(self._wakeup_w, b'\0')
+
+    def wait_for_output(self, pattern, timeout=None):
+        """
+        Blocks until pattern (regex) shows up in stdout or stderr, e.g. a
+        readiness message. Returns the match object, or None if the process
+        exited or timeout expired before. Patterns are matched per line.
+        """
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        # Absolute offset after the last complete line already searched
+        since = {id(self.stdout_buf): 0, id(self.stderr_buf): 0}
+        with self.output_cond:
+            while True:
+                for buf in (self.stdout_buf, self.stderr_buf):
+                    start = max(since[id(buf)], buf.dropped)
+                    data = buf.tail(start)
+                    match = pattern.search(data.decode("utf-8", errors="replace"))
+                    if match:
+                        return match
+                    since[id(buf)] = start + data.rfind(b'\n') + 1
+
+                if self.finished:
+                    return None
+
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                self.output_cond.wait(remaining)
 
     def print_output(self):
         self.collect()
@@ -89,15 +364,17 @@ class ExecAsyncHandler(threading.Thread):
             sys.stderr.write(f"{self.sig_name}: Returncode {self.retcode}: {self.cmd_str}\n")
 
     def collect(self):
-        while self.is_alive():
-            time.sleep(0.1)
-
+        self.join()
         return self.retcode, self.stderr, self.stdout
 
 
 
-def exec_async(cmd, timeout=10):
-    handler = ExecAsyncHandler(cmd, timeout)
+def exec_async(cmd, timeout=10, ports=None, output_limit=1 << 20, spill=False, sample_interval=None):
+    # Fill in command templates such as [binary, "{port}"] with leased ports
+    if ports is not None:
+        cmd = [arg.format(**ports) for arg in cmd]
+
+    handler = ExecAsyncHandler(cmd, timeout, output_limit, spill, sample_interval)
     handler.start()
     return handler
 
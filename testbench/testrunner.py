@@ -2,49 +2,47 @@ import os
 import time
 import logging
 import subprocess
-import threading
+import shutil
 import sys
 from functools import wraps
 import traceback
+import io
+import contextlib
 
 try:
     import custom_logging
+    import test_utils
+    import report
+    import probes
+    import connpool
+    import discovery
+    import cache
+    from fixtures import TestFailed, TEST_FAILED, CLEANUP, cleanup
 except (ImportError, ModuleNotFoundError):
     from . import custom_logging
+    from . import test_utils
+    from . import report
+    from . import probes
+    from . import connpool
+    from . import discovery
+    from . import cache
+    from .fixtures import TestFailed, TEST_FAILED, CLEANUP, cleanup
 
 # Logging setup
 log = logging.getLogger(__name__)
 
 
-class TestFailed(object):
-    def __init__(self, failed):
-        self._failed = failed
-        self.lock = threading.RLock()
-
-    @property
-    def get_failed(self):
-        self.lock.acquire()
-        return self._failed
-        self.lock.release()
-
-
-    def set_failed(self, x):
-        self.lock.acquire()
-        self._failed = x
-        self.lock.release()
-
-
 # Test globals
 TEST_ARRAY = []
-TEST_FAILED = TestFailed(True)
-CLEANUP = []
 DEBUG = False
 
 class TestFunc:
     def __init__(self, wrapper, func_name, result=None):
         self.func_name = func_name
+        self.module = wrapper.__module__
         self.wrapper = wrapper
         self.result = result
+        self.resources = []
 
     def run(self, **kwargs):
         return self.wrapper(**kwargs)
@@ -68,20 +66,6 @@ def test(func):
     TEST_ARRAY.append(TestFunc(wrapper, func.__name__))
     return wrapper
 
-def cleanup(func):
-    @wraps(func)
-    def wrapper(*args, **kwds):
-        global TEST_FAILED, CLEANUP, TEST_ARRAY
-        kwds["failure"] = TEST_FAILED
-        try:
-            iterator = func(*args, **kwds)
-        except TypeError as ex:
-            log.fatal(f"Cleanup function {func.__name__} signature needs a **kwarg argument.")
-            exit(1)
-        CLEANUP.append(iterator)
-        return next(iterator)
-    return wrapper
-
 def assertEqual(a,b, msg=None):
     if a != b:
         if msg is None:
@@ -94,27 +78,346 @@ def assertEqual(a,b, msg=None):
 
 
 def get_term_filler(name):
-    width, height = os.get_terminal_size()
+    width, height = shutil.get_terminal_size()
     filler = round((width - len(name)) / 2 -2)
     return filler
 
-def main():
-    global TEST_FAILED, CLEANUP, TEST_ARRAY, DEBUG
+def print_banner(name):
+    filler = get_term_filler(name)
+    print("="*filler + f" {name} " + "="*filler)
+
+def run_cleanup():
+    # Cleanup phase
+    timings = []
+    for clean_func in CLEANUP:
+        log.debug(f"Cleaning up function: {clean_func.__name__} ")
+        start = time.monotonic()
+        try:
+            res = next(clean_func)
+            log.error(f"Cleanup function {clean_func.__name__} has a second yield. This is not allowed")
+            log.error("Failed to cleanup. Zombie processes may be still alive")
+        except StopIteration:
+            pass
+        timings.append((clean_func.__name__, time.monotonic() - start))
+    CLEANUP.clear()
+    return timings
+
+def wait_ports_released(deadline):
+    """
+    Waits until the ports used by the last test are no longer bound so the next
+    test can reuse them, at most until deadline (monotonic clock).
+    """
+    for port, udp in probes.take_used_ports():
+        if not probes.wait_port_free(port, max(deadline - time.monotonic(), 0), udp=udp):
+            log.debug(f"Port {port} still in use after test")
+
+
+def run_test(test, build_dir):
+    start = time.monotonic()
+    res = test.run(build_dir=build_dir)
+    duration = time.monotonic() - start
+    if res is not None:
+        log.exception("Test failed. Reason: ", exc_info=res)
+        TEST_FAILED.set_failed(True)
+    else:
+        log.info("Test succeeded")
+        TEST_FAILED.set_failed(False)
+
+    # Run cleanup functions
+    cleanup_times = run_cleanup()
+    # Pooled connections must not outlive the peers of this test
+    connpool.POOL.close()
+
+    # Resource summaries of binaries started with sample_interval
+    test.resources = test_utils.take_resource_usage()
+    for cmd, usage in test.resources:
+        log.info(f"Resources of {cmd}: {usage}")
+
+    test.result = report.TestResult(test.func_name, test.module, res, duration, cleanup_times,
+                                    [(cmd, usage.summary()) for cmd, usage in test.resources])
+    return test.result
+
+def _run_test_worker(index, build_dir, conn):
+    """
+    Executes TEST_ARRAY[index] inside a worker process and sends
+    (result, output) through conn. Every worker is a fresh fork of the
+    runner, so CLEANUP and TEST_FAILED are private to the test. Log records
+    and stdout/stderr are captured and handed back to the parent so the
+    output of concurrent tests does not interleave.
+    """
+    test = TEST_ARRAY[index]
+    output = io.StringIO()
+
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(output)
+
+    CLEANUP.clear()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            result = run_test(test, build_dir)
+        except BaseException as ex:
+            # e.g. exit() in a test or a fixture with a bad signature
+            log.exception("Test aborted. Reason: ", exc_info=ex)
+            result = report.TestResult(test.func_name, test.module, ex)
+        finally:
+            run_cleanup()
 
+    conn.send((result, output.getvalue()))
+    conn.close()
+
+def run_parallel(selected, build_dir, jobs, replayed=None):
+    import multiprocessing
+    import multiprocessing.connection
+
+    replayed = replayed if replayed is not None else {}
+    # Fork so workers inherit the already imported test modules
+    ctx = multiprocessing.get_context("fork")
+    waiting = [i for i in selected if i not in replayed]
+    # index -> (process, receiving end of its pipe)
+    running = {}
+    finished = {}
+    results = []
+    try:
+        while True:
+            # Print in declaration order
+            while len(results) < len(selected):
+                index = selected[len(results)]
+                if index in replayed:
+                    print_replayed(index)
+                    results.append(replayed[index])
+                elif index in finished:
+                    result, output = finished.pop(index)
+                    print_banner(TEST_ARRAY[index].func_name)
+                    sys.stdout.flush()
+                    sys.stderr.write(output)
+                    TEST_ARRAY[index].result = result
+                    results.append(result)
+                else:
+                    break
+            if len(results) == len(selected):
+                break
+
+            while waiting and len(running) < jobs:
+                index = waiting.pop(0)
+                recv, send = ctx.Pipe(duplex=False)
+                process = ctx.Process(target=_run_test_worker, args=(index, build_dir, send), daemon=True)
+                process.start()
+                send.close()
+                running[index] = (process, recv)
+
+            ready = multiprocessing.connection.wait([recv for _, recv in running.values()])
+            for index, (process, recv) in list(running.items()):
+                if recv not in ready:
+                    continue
+                try:
+                    finished[index] = recv.recv()
+                except EOFError:
+                    # The worker died without sending a result
+                    process.join()
+                    test = TEST_ARRAY[index]
+                    error = RuntimeError(f"Worker process died with exit code {process.exitcode}")
+                    finished[index] = (report.TestResult(test.func_name, test.module, error),
+                                       f"Test failed. Reason: {error}\n")
+                process.join()
+                recv.close()
+                del running[index]
+    except KeyboardInterrupt:
+        log.error("Interrupted. Terminating workers")
+        for process, _ in running.values():
+            process.terminate()
+        exit(0)
+
+    failed = sum(1 for r in results if not r.succeeded)
+    log.info(f"{len(selected) - failed} of {len(selected)} tests succeeded")
+    TEST_FAILED.set_failed(failed > 0)
+    return results
+
+def select_modules(test_paths, whitelist):
+    """
+    Returns the test files whose statically discovered tests include one of
+    the whitelisted functions. If a whitelisted function is not found in
+    any file, e.g. because it is registered dynamically, all files are kept.
+    """
+    index = discovery.DiscoveryIndex()
+    selected = []
+    found = set()
+    for test_path in test_paths:
+        try:
+            names = index.tests(test_path)
+        except (OSError, SyntaxError, ValueError) as ex:
+            # Let the import report the problem
+            log.debug(f"Could not scan {test_path}: {ex}")
+            selected.append(test_path)
+            continue
+        if whitelist.intersection(names):
+            selected.append(test_path)
+            found.update(whitelist.intersection(names))
+    index.save()
+
+    if found != whitelist:
+        log.debug(f"Tests {sorted(whitelist - found)} not found statically, importing all test modules")
+        return test_paths
+    return selected
+
+def build_parser(prog='testbench'):
     import argparse
-    import importlib
-    import pathlib
 
     parser = argparse.ArgumentParser(
-                    prog = 'testbench',
+                    prog = prog,
                     description = 'Loads and executes tests')
 
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("-t", "--test", nargs="?", required=True, action="append")
     parser.add_argument("-bd", "--build_dir", action="store",  default="build")
     parser.add_argument("-tf", "--test_func", nargs="?", action="append")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of worker processes to run tests in parallel")
+    parser.add_argument("--report", action="append", default=[],
+                        help="Write results to this path, JUnit XML for *.xml, JSON lines otherwise")
+    parser.add_argument("--slowest", type=int, default=5,
+                        help="Number of slowest tests to list at the end")
+    parser.add_argument("--no-discovery", action="store_true",
+                        help="Import all test modules instead of only those containing the -tf tests")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Run all tests, even those with a cached pass for unchanged inputs")
+    parser.add_argument("--cache-size", type=int, default=16,
+                        help="Size limit of the result cache in MiB")
    # parser.add_argument("-d", "--debug", action="store_true")
-    args = parser.parse_args()
+    return parser
+
+def import_test_module(test_path, reload=False):
+    """
+    Imports a test file given with -t, which registers its tests in
+    TEST_ARRAY, and returns the module. With reload an already imported
+    module is executed again, replacing the tests it registered before.
+    """
+    import importlib
+    import pathlib
+
+    sp = pathlib.Path(test_path)
+    script_dir = sp.with_suffix("").resolve().parent.as_posix()
+    sys.path.append(script_dir)
+
+    test_stem = sp.stem
+    log.info(f"Loading test: {test_stem}")
+    try:
+        if reload and test_stem in sys.modules:
+            TEST_ARRAY[:] = [t for t in TEST_ARRAY if t.module != test_stem]
+            return importlib.reload(sys.modules[test_stem])
+        return importlib.import_module(test_stem)
+    except ModuleNotFoundError as ex:
+        log.error(f"Module search path is: {script_dir}")
+        log.error(f"Couldn't load module: {test_stem}", exc_info=ex)
+        exit(1)
+    finally:
+        sys.path.pop()
+
+def select_tests(whitelist, modules=None):
+    """
+    Indices of the tests in TEST_ARRAY to run, restricted to the given
+    module names if any.
+    """
+    return [i for i, test in enumerate(TEST_ARRAY)
+            if (len(whitelist) == 0 or test.func_name in whitelist) and
+            (modules is None or test.module in modules)]
+
+def open_result_cache(args):
+    if args.no_cache:
+        return None
+    return cache.ResultCache(max_bytes=args.cache_size << 20)
+
+def run_tests(selected, build_dir, jobs=1, result_cache=None):
+    """
+    Runs TEST_ARRAY[i] for all selected indices and returns their results.
+    Tests with a pass in result_cache for the same inputs are not executed
+    but their cached result is replayed; new passes are stored.
+    """
+    keys = {}
+    replayed = {}
+    if result_cache is not None:
+        for i in selected:
+            test = TEST_ARRAY[i]
+            keys[i] = result_cache.key(test, build_dir)
+            entry = result_cache.get(keys[i])
+            if entry is not None:
+                test.result = report.TestResult.from_dict(entry)
+                test.result.cached = True
+                replayed[i] = test.result
+
+    if jobs > 1:
+        results = run_parallel(selected, build_dir, jobs, replayed)
+    else:
+        results = run_sequential(selected, build_dir, replayed)
+
+    if result_cache is not None:
+        for i, result in zip(selected, results):
+            if i not in replayed:
+                result_cache.put(keys[i], result)
+        result_cache.evict()
+
+    return results
+
+def print_replayed(index):
+    print_banner(TEST_ARRAY[index].func_name)
+    log.info("Test succeeded (cached result, inputs unchanged)")
+
+def run_sequential(selected, build_dir, replayed=None):
+    """
+    Runs the selected tests one after another. Tests in replayed (index ->
+    cached result) are only reported, in declaration order with the others.
+    """
+    replayed = replayed if replayed is not None else {}
+    executed = [i for i in selected if i not in replayed]
+    results = []
+    try:
+        for i in selected:
+            if i in replayed:
+                print_replayed(i)
+                results.append(replayed[i])
+                continue
+
+            test = TEST_ARRAY[i]
+            print_banner(test.func_name)
+
+            # Test execution phase
+            results.append(run_test(test, build_dir))
+
+            # Skip wait if last executed test function
+            if i != executed[-1]:
+                start = time.monotonic()
+                wait_ports_released(start + 1.0)
+                results[-1].wait = time.monotonic() - start
+    except KeyboardInterrupt:
+        while True:
+            try:
+                run_cleanup()
+                exit(0)
+            except KeyboardInterrupt:
+                log.error("Please wait for the cleanup to finish")
+
+    return results
+
+def main():
+    global TEST_FAILED, CLEANUP, TEST_ARRAY, DEBUG
+
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        try:
+            import bench
+        except (ImportError, ModuleNotFoundError):
+            from . import bench
+        return bench.main(sys.argv[2:])
+
+    if len(sys.argv) > 1 and sys.argv[1] in ("serve", "remote"):
+        try:
+            import serve
+        except (ImportError, ModuleNotFoundError):
+            from . import serve
+        if sys.argv[1] == "serve":
+            return serve.main(sys.argv[2:])
+        return serve.remote(sys.argv[2:])
+
+    args = build_parser().parse_args()
 
    # DEBUG = args.debug
 
@@ -133,69 +436,32 @@ def main():
         for func in args.test_func:
             whitelist.add(func)
 
-    # Import tests
-    for test_path in args.test:
-        sp = pathlib.Path(test_path)
-        script_dir = sp.with_suffix("").resolve().parent.as_posix()
-        sys.path.append(script_dir)
+    test_paths = args.test
+    if whitelist and not args.no_discovery:
+        test_paths = select_modules(test_paths, whitelist)
 
-        test_stem = sp.stem
-        log.info(f"Loading test: {test_stem}")
-        try:
-            mod = importlib.import_module(test_stem)
-        except ModuleNotFoundError as ex:
-            log.error(f"Module search path is: {script_dir}")
-            log.error(f"Couldn't load module: {test_stem}", exc_info=ex)
-            exit(1)
-        finally:
-            sys.path.pop()
+    # Import tests
+    for test_path in test_paths:
+        import_test_module(test_path)
 
     if len(TEST_ARRAY) == 0:
         log.error("No tests have been found!")
         exit(1)
 
-    def run_cleanup():
-        # Cleanup phase
-        for clean_func in CLEANUP:
-            log.debug(f"Cleaning up function: {clean_func.__name__} ")
-            try:
-                res = next(clean_func)
-                log.error(f"Cleanup function {clean_func.__name__} has a second yield. This is not allowed")
-                log.error("Failed to cleanup. Zombie processes may be still alive")
-            except StopIteration:
-                pass
-
-
-    try:
-        for i, test in enumerate(TEST_ARRAY):
-            if test.func_name not in whitelist and len(whitelist) > 0:
-                continue
-
-            filler = get_term_filler(test.func_name)
-            print("="*filler + f" {test.func_name} " + "="*filler)
+    selected = select_tests(whitelist)
+    results = run_tests(selected, build_dir, args.jobs, open_result_cache(args))
+    finish(results, args)
 
-            # Test execution phase
-            res = test.run(build_dir=build_dir)
-            if res is not None:
-                log.exception("Test failed. Reason: ", exc_info=res)
-                TEST_FAILED.set_failed(True)
-            else:
-                log.info("Test succeeded")
-                TEST_FAILED.set_failed(False)
-
-            # Run cleanup functions
-            run_cleanup()
+def finish(results, args):
+    for path in args.report:
+        report.write_report(path, results)
+        log.info(f"Wrote report to {path}")
 
-            # Skip wait if last test function
-            if i != len(TEST_ARRAY)-1:
-                time.sleep(1)
-    except KeyboardInterrupt:
-        while True:
-            try:
-                run_cleanup()
-                exit(0)
-            except KeyboardInterrupt:
-                log.error("Please wait for the cleanup to finish")
+    lines = report.slowest(results, args.slowest) if args.slowest > 0 and len(results) > 1 else []
+    if lines:
+        print(f"Slowest {len(lines)} tests:")
+        for line in lines:
+            print(line)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,272 @@
+import array
+import bisect
+import hashlib
+import struct
+import mmap
+import os
+import socket
+import logging
+
+try:
+    from .packet import Packet, DataPacket, LazyDataPacket, ControlPacket, NTPPacket
+    from .recorder import MAGIC, RECORD, UDP, Record
+except (ImportError, ModuleNotFoundError):
+    from packet import Packet, DataPacket, LazyDataPacket, ControlPacket, NTPPacket
+    from recorder import MAGIC, RECORD, UDP, Record
+
+log = logging.getLogger(__name__)
+
+INDEX_MAGIC = b'TBIDX\x00\x01\x00'
+# magic, trace size, trace mtime (ns), number of records, number of index entries
+INDEX_HEADER = struct.Struct('<8sQQQQ')
+
+# Index keys are (kind << 56) | value
+KIND_TYPE = 1
+KIND_HASH_ID = 2
+KIND_NODE_ID = 3
+KIND_KEY = 4
+
+PACKET_TYPES = {DataPacket: 1, ControlPacket: 2, NTPPacket: 3}
+METHODS = ['GET', 'SET', 'DELETE', 'REPLY', 'LOOKUP', 'STABILIZE', 'NOTIFY', 'JOIN', 'FACK', 'FINGER']
+METHOD_CODES = {m: i + 1 for i, m in enumerate(METHODS)}
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=6).digest(), 'big')
+
+
+def _classify(proto, data):
+    """
+    Returns (packet type code, method code, hash_id, node_id, key) from the
+    header of a recorded packet without parsing all of it. NTP packets use
+    their mode as method code. Unparsable records get type code 0.
+    """
+    try:
+        if proto == UDP:
+            if len(data) < 48:
+                return 0, 0, None, None, None
+            return PACKET_TYPES[NTPPacket], data[0] & 0b111, None, None, None
+
+        if Packet.packet_type(data) == ControlPacket:
+            flags, hash_id, node_id, _, _ = ControlPacket.RECORD.unpack_from(data)
+            method = ControlPacket._method_table()[flags]
+            if method is None:
+                return 0, 0, None, None, None
+            return PACKET_TYPES[ControlPacket], METHOD_CODES[method], hash_id, node_id, None
+
+        key_len, value_len = DataPacket.len_from_header(data)
+        method, _ = DataPacket.flags_from_header(data)
+        if len(data) < 7 + key_len + value_len:
+            return 0, 0, None, None, None
+        return PACKET_TYPES[DataPacket], METHOD_CODES[method], None, None, data[7:7 + key_len]
+    except (ValueError, struct.error):
+        return 0, 0, None, None, None
+
+
+class TraceEntry(Record):
+    """
+    Record of a trace whose data is a view into the mapped file. The packet
+    is only decoded on first access, DataPackets as LazyDataPacket.
+    """
+    __slots__ = ('offset', '_packet')
+
+    def __init__(self, offset, *args):
+        super().__init__(*args)
+        self.offset = offset
+        self._packet = None
+
+    @property
+    def packet(self):
+        if self._packet is None:
+            if self.proto == UDP:
+                self._packet = NTPPacket.parse(bytes(self.data))
+            elif Packet.packet_type(self.data) == ControlPacket:
+                self._packet = ControlPacket.parse(bytes(self.data))
+            else:
+                self._packet = LazyDataPacket(self.data)
+        return self._packet
+
+
+class TraceReader:
+    """
+    Memory mapped reader for traffic recordings (see recorder.py) of any
+    size. A sorted (key, offset) index by packet type and method, hash_id,
+    node_id and key hash is kept next to the trace in path + '.idx' and only
+    rebuilt when the trace changed, so queries touch just the matching
+    records.
+
+    Entries hold views into the mapping; drop them before close().
+
+    Examples
+    ----------
+    > with TraceReader("soak.tbrec") as trace:
+    >     lookups = trace.query(ControlPacket, 'LOOKUP', hash_id=42)
+    >     sets = trace.query(DataPacket, 'SET', key=b'foo')
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path if index_path is not None else path + '.idx'
+        self._index_file = None
+        self._index_map = None
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a testbench recording')
+
+        if not self._load_index():
+            self.build_index()
+            self._load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for offset in self._offsets():
+            yield self.entry(offset)
+
+    def _offsets(self):
+        # Offsets of all complete records
+        offset = len(MAGIC)
+        size = len(self.map)
+        while offset + RECORD.size <= size:
+            length = struct.unpack_from('>I', self.map, offset + RECORD.size - 4)[0]
+            if offset + RECORD.size + length > size:
+                return
+            yield offset
+            offset += RECORD.size + length
+
+    def entry(self, offset):
+        ts, direction, proto, src_ip, src_port, dst_ip, dst_port, length = RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        data = memoryview(self.map)[start:start + length]
+        return TraceEntry(offset, ts, direction, proto, (socket.inet_ntoa(src_ip), src_port),
+                          (socket.inet_ntoa(dst_ip), dst_port), data)
+
+    def build_index(self):
+        st = os.fstat(self.file.fileno())
+        pairs = []
+        count = 0
+        view = memoryview(self.map)
+        for offset in self._offsets():
+            count += 1
+            proto = self.map[offset + 9]
+            length = struct.unpack_from('>I', self.map, offset + RECORD.size - 4)[0]
+            start = offset + RECORD.size
+            ptype, method, hash_id, node_id, key = _classify(proto, view[start:start + length])
+            if ptype == 0:
+                continue
+
+            pairs.append(((KIND_TYPE << 56) | (ptype << 8) | method, offset))
+            if hash_id is not None:
+                pairs.append(((KIND_HASH_ID << 56) | hash_id, offset))
+                pairs.append(((KIND_NODE_ID << 56) | node_id, offset))
+            if key is not None:
+                pairs.append(((KIND_KEY << 56) | key_hash(key), offset))
+        view.release()
+        pairs.sort()
+
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, st.st_size, st.st_mtime_ns, count, len(pairs)))
+            array.array('Q', (k for k, _ in pairs)).tofile(f)
+            array.array('Q', (o for _, o in pairs)).tofile(f)
+        os.replace(tmp, self.index_path)
+        log.debug(f"Indexed {count} records of {self.path}")
+
+    def _load_index(self):
+        try:
+            f = open(self.index_path, 'rb')
+        except FileNotFoundError:
+            return False
+
+        header = f.read(INDEX_HEADER.size)
+        st = os.fstat(self.file.fileno())
+        if len(header) < INDEX_HEADER.size:
+            f.close()
+            return False
+        magic, size, mtime, count, n = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC or size != st.st_size or mtime != st.st_mtime_ns:
+            f.close()
+            return False
+
+        self._index_file = f
+        self.count = count
+        if n == 0:
+            self.keys = self.offsets = []
+            return True
+        self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._entries = memoryview(self._index_map)[INDEX_HEADER.size:INDEX_HEADER.size + 16 * n]
+        self.keys = self._entries[:8 * n].cast('Q')
+        self.offsets = self._entries[8 * n:].cast('Q')
+        return True
+
+    def _range(self, lo, hi):
+        # Offsets of all index entries with lo <= key <= hi
+        i = bisect.bisect_left(self.keys, lo)
+        j = bisect.bisect_right(self.keys, hi)
+        return self.offsets[i:j]
+
+    def query(self, packet_type=None, method=None, hash_id=None, node_id=None, key=None, direction=None):
+        """
+        Yields the entries matching all given conditions in recording order.
+        method is the method name, or the mode for NTPPackets.
+        """
+        ptype = PACKET_TYPES[packet_type] if packet_type is not None else None
+        if isinstance(method, str):
+            method = METHOD_CODES[method]
+
+        if key is not None:
+            h = (KIND_KEY << 56) | key_hash(key)
+            offsets = self._range(h, h)
+        elif hash_id is not None:
+            offsets = self._range((KIND_HASH_ID << 56) | hash_id, (KIND_HASH_ID << 56) | hash_id)
+        elif node_id is not None:
+            offsets = self._range((KIND_NODE_ID << 56) | node_id, (KIND_NODE_ID << 56) | node_id)
+        elif ptype is not None:
+            base = (KIND_TYPE << 56) | (ptype << 8)
+            if method is not None:
+                offsets = self._range(base | method, base | method)
+            else:
+                offsets = sorted(self._range(base, base | 0xff))
+        else:
+            offsets = self._offsets()
+
+        view = memoryview(self.map)
+        try:
+            for offset in offsets:
+                if direction is not None and self.map[offset + 8] != direction:
+                    continue
+
+                proto = self.map[offset + 9]
+                length = struct.unpack_from('>I', self.map, offset + RECORD.size - 4)[0]
+                start = offset + RECORD.size
+                data = view[start:start + length]
+                p, m, h, n, k = _classify(proto, data)
+                matches = (ptype is None or p == ptype) and (method is None or m == method) and \
+                    (hash_id is None or h == hash_id) and (node_id is None or n == node_id) and \
+                    (key is None or k == key)
+                data.release()
+                if matches:
+                    yield self.entry(offset)
+        finally:
+            view.release()
+
+    def close(self):
+        for name in ('keys', 'offsets', '_entries'):
+            view = getattr(self, name, None)
+            if isinstance(view, memoryview):
+                view.release()
+        if self._index_map is not None:
+            self._index_map.close()
+        if self._index_file is not None:
+            self._index_file.close()
+        self.map.close()
+        self.file.close()